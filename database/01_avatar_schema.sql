@@ -18,7 +18,8 @@ CREATE TABLE playbooks (
     connections             JSON,
     moment_of_balance       VARCHAR(1024),
     growth_question         VARCHAR(255),
-    PRIMARY KEY(id)
+    PRIMARY KEY(id),
+    UNIQUE KEY ux_playbooks_name (name)
 )
 ;
 
@@ -58,7 +59,10 @@ CREATE TABLE moves ( -- need to redo this. does not fit balance moves
     miss_outcome                    VARCHAR(255),
     weak_hit_outcome                VARCHAR(255),
     strong_hit_outcome              VARCHAR(255),
-    PRIMARY KEY(id)
+    PRIMARY KEY(id),
+    KEY ix_moves_move_type (move_type),
+    KEY ix_moves_playbook_id (playbook_id),
+    KEY ix_moves_statistic (statistic)
 )
 ;
 
@@ -78,9 +82,24 @@ CREATE TABLE techniques (
     conditions_inflicted            VARCHAR(100), -- add statuses cleared and inflicted
     is_blockable                    BOOLEAN,
     is_rare                         BOOLEAN,
+    PRIMARY KEY(id),
+    KEY ix_techniques_type_training (technique_type, req_training),
+    KEY ix_techniques_req_training (req_training),
+    KEY ix_techniques_playbook_id (playbook_id),
+    KEY ix_techniques_approach (approach)
+)
+;
+
+-- Catalog version stamp. Bump whenever playbooks, moves or techniques change so app caches reload
+CREATE TABLE catalog_version (
+    id                              SMALLINT NOT NULL,
+    version                         INT NOT NULL DEFAULT 0,
+    updated_at                      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    checksum                        CHAR(64), -- content last loaded by webapp/catalog_cli.py
     PRIMARY KEY(id)
 )
 ;
+INSERT INTO catalog_version (id, version) VALUES (1, 0);
 
 -- Conditions
 CREATE TABLE conditions (
@@ -107,10 +126,11 @@ CREATE TABLE statuses (
 CREATE TABLE players (
     id                              CHAR(32) NOT NULL,
     name                            VARCHAR(255) NOT NULL,
-    password_hash                   CHAR(32) NOT NULL,
+    password_hash                   VARCHAR(255) NOT NULL,
     created_at                      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at                      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    PRIMARY KEY(id)
+    PRIMARY KEY(id),
+    UNIQUE KEY ux_players_name (name)
 )
 ;
 
@@ -143,8 +163,9 @@ CREATE TABLE characters (
     growth_advancements             SMALLINT DEFAULT 0,
     mob_unlocked                    BOOLEAN DEFAULT FALSE, -- "mob" = moment of balance
     created_at                      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at                      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at                      TIMESTAMP(6) DEFAULT CURRENT_TIMESTAMP(6), -- row version for If-Match
     PRIMARY KEY(id),
+    UNIQUE KEY ux_characters_player_name (player_id, name),
     FOREIGN KEY(player_id) REFERENCES players (id) ON DELETE CASCADE,
     FOREIGN KEY(playbook_id) REFERENCES playbooks (id)
 )
@@ -154,15 +175,17 @@ CREATE TABLE characters (
 CREATE TABLE character_moves (
     character_id                    CHAR(32) NOT NULL,
     move_id                         CHAR(32) NOT NULL,
+    PRIMARY KEY(character_id, move_id),
     FOREIGN KEY(character_id) REFERENCES characters (id) ON DELETE CASCADE,
     FOREIGN KEY(move_id) REFERENCES moves (id) ON DELETE CASCADE
 )
 ;
 
 CREATE TABLE character_techniques (
-    character_id                    CHAR(32),
-    technique_id                    CHAR(32),
+    character_id                    CHAR(32) NOT NULL,
+    technique_id                    CHAR(32) NOT NULL,
     mastery                         ENUM('Basic','Learned','Practiced','Mastered'),
+    PRIMARY KEY(character_id, technique_id),
     FOREIGN KEY(character_id) REFERENCES characters (id) ON DELETE CASCADE,
     FOREIGN KEY(technique_id) REFERENCES techniques (id) ON DELETE CASCADE
 )
@@ -1,10 +1,80 @@
 #!/usr/bin/env python
 
 import os
-from application import app
+import sys
+import subprocess
 
+# SERVER_MODE=production serves through gunicorn, anything else uses the flask development server
+SERVER_MODE = os.environ.get('SERVER_MODE', 'development')
 FLASK_APP_HOST = os.environ['FLASK_APP_HOST']
 FLASK_APP_PORT = int(os.environ['FLASK_APP_PORT'])
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 2 * (os.cpu_count() or 1) + 1))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 4)) # keep at or below DB_POOL_SIZE + DB_MAX_OVERFLOW
+# gthread gives each open request a thread, so live streams (/api/characters/live) are capped at WEB_THREADS - 1 per
+# worker. gevent holds WEB_WORKER_CONNECTIONS idle streams per worker cheaply. the hub is in-process, so a stream only
+# hears writes handled by its own worker: live updates need WEB_WORKER_CLASS=gevent and WEB_WORKERS=1, see application/live.py.
+# gevent runs requests on one OS thread, so cpu-bound password hashing goes to native threads, see application/passwords.py
+WEB_WORKER_CLASS = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+WEB_WORKER_CONNECTIONS = int(os.environ.get('WEB_WORKER_CONNECTIONS', 2000))
+WEB_TIMEOUT = int(os.environ.get('WEB_TIMEOUT', 30))
+WEB_MAX_REQUESTS = int(os.environ.get('WEB_MAX_REQUESTS', 10000)) # recycle workers to bound memory growth
+AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE', 'false').lower() in ('1', 'true', 'yes')
+# rules content loaded at startup, skipped quickly when unchanged. see application/catalog_loader.py
+CATALOG_DIR = os.environ.get('CATALOG_DIR')
+
+WEBAPP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# startup tasks run in a child process: importing application here would start its log listener thread in the
+# gunicorn master, and forked workers would inherit the queue handler without the thread that drains it
+
+def migrate():
+    ''' Apply pending schema migrations once, before any workers start '''
+    subprocess.check_call([sys.executable, '-m', 'application.migrations', 'upgrade'], cwd = WEBAPP_DIR)
+
+def load_catalog():
+    subprocess.check_call([sys.executable, 'catalog_cli.py', 'load', CATALOG_DIR], cwd = WEBAPP_DIR)
+
+def run_production():
+    from gunicorn.app.base import BaseApplication
+
+    class AvatarApplication(BaseApplication):
+        ''' Multi-worker, multi-thread gunicorn server. Each worker imports the app, so no pools are shared across forks '''
+
+        def load_config(self):
+            options = {
+                'bind': '{}:{}'.format(FLASK_APP_HOST, FLASK_APP_PORT),
+                'workers': WEB_WORKERS,
+                'threads': WEB_THREADS,
+                'worker_class': WEB_WORKER_CLASS,
+                'worker_connections': WEB_WORKER_CONNECTIONS,
+                'timeout': WEB_TIMEOUT,
+                'max_requests': WEB_MAX_REQUESTS,
+                'max_requests_jitter': WEB_MAX_REQUESTS // 10
+            }
+            for k, v in options.items():
+                self.cfg.set(k, v)
+            self.cfg.set('when_ready', lambda server: self.ready(server, options))
+
+        def ready(self, server, options):
+            server.log.info('Server settings %s', options)
+            if WEB_WORKER_CLASS != 'gevent' or WEB_WORKERS > 1:
+                server.log.warning('Live character streams need WEB_WORKER_CLASS=gevent and WEB_WORKERS=1, running %d %s '
+                                   'workers. streams only hear writes handled by their own worker, and a gthread worker '
+                                   'holds at most WEB_THREADS - 1 of them', WEB_WORKERS, WEB_WORKER_CLASS)
+
+        def load(self):
+            from application import app
+            return app
+
+    AvatarApplication().run()
 
 if __name__ == '__main__':
-    app.run(host = FLASK_APP_HOST, port = FLASK_APP_PORT)
\ No newline at end of file
+    if AUTO_MIGRATE:
+        migrate()
+    if CATALOG_DIR:
+        load_catalog()
+    if SERVER_MODE == 'production':
+        run_production()
+    else:
+        from application import app
+        app.run(host = FLASK_APP_HOST, port = FLASK_APP_PORT)
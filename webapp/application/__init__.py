@@ -1,26 +1,78 @@
 #!/usr/bin/env python
 
 import os
+import queue
+import atexit
 import logging
 import logging.config
+import logging.handlers
 import yaml
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
+from . import metrics, compression
+from .assets import assets
+from .replicas import RoutingSQLAlchemy, router
+
 FLASK_SECRET_KEY = os.environ['FLASK_SECRET_KEY']
-DB_USER = os.environ['MYSQL_DB_USER'] 
-DB_PASS = os.environ['MYSQL_DB_PASS'] 
-DB_PORT = os.environ['MYSQL_DB_PORT']
-DB_URI = 'mysql+pymysql://{}:{}@mysql:{}/avatar'.format(DB_USER, DB_PASS, DB_PORT)
+DB_URI = os.environ.get('DATABASE_URI') # override for local runs and benchmarks, e.g. sqlite:////tmp/avatar.db
+if not DB_URI:
+    DB_USER = os.environ['MYSQL_DB_USER'] 
+    DB_PASS = os.environ['MYSQL_DB_PASS'] 
+    DB_PORT = os.environ['MYSQL_DB_PORT']
+    DB_URI = 'mysql+pymysql://{}:{}@mysql:{}/avatar'.format(DB_USER, DB_PASS, DB_PORT)
+# connection pool, ignored for sqlite. recycle stays well under MySQL's wait_timeout
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+LOG_DIR = os.environ.get('FLASK_LOG_DIR', '/logs')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG' if os.environ.get('FLASK_ENV') == 'development' else 'INFO')
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def configure_logging(conf):
+    """Apply the dictConfig, then route every configured logger through one queue drained by a background thread."""
+    conf['handlers']['logfile']['filename'] = os.path.join(LOG_DIR, 'flask.log')
+    for name in ['routes', 'db_model', 'forms']:
+        conf['loggers'][name]['level'] = LOG_LEVEL
+    logging.config.dictConfig(conf)
 
-with open('application/logging_conf.yaml', 'r') as f:
-    logging.config.dictConfig(yaml.safe_load(f.read()))
+    handlers = {}
+    for name in conf['loggers']:
+        log = logging.getLogger(name)
+        for h in log.handlers:
+            handlers[id(h)] = h
+        log.handlers = []
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    for name in conf['loggers']:
+        logging.getLogger(name).addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, *handlers.values(), respect_handler_level = True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+with open(os.path.join(APP_DIR, 'logging_conf.yaml'), 'r') as f:
+    log_listener = configure_logging(yaml.safe_load(f.read()))
 logger = logging.getLogger(__name__)
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy() # reads go to replicas when DATABASE_REPLICA_URIS is set, see replicas.py
 login_manager = LoginManager()
 
+def engine_options(uri):
+    """SQLAlchemy engine options for the configured database."""
+    if uri.startswith('sqlite'):
+        return {}
+    return {
+        'poolclass': metrics.TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_timeout': DB_POOL_TIMEOUT
+    }
+
 def create_app():
     """Construct the core application."""
     app = Flask(__name__)
@@ -28,9 +80,18 @@ def create_app():
     app.config['SECRET_KEY'] = FLASK_SECRET_KEY
     app.config['SQLALCHEMY_DATABASE_URI'] = DB_URI
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DB_URI)
+    logger.info('Database %s, engine options %s', DB_URI.split('@')[-1],
+                {k: v for k, v in app.config['SQLALCHEMY_ENGINE_OPTIONS'].items() if k != 'poolclass'})
 
+    router.init_app(app) # before db so the replica binds are configured
     db.init_app(app)
+    # after_request hooks run in reverse registration order: login's cookie hook, then compression, then metrics,
+    # so request latency includes compression time
+    metrics.init_app(app)
+    compression.init_app(app)
     login_manager.init_app(app)
+    assets.init_app(app)
 
     return app
 
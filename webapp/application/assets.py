@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+import mimetypes
+import threading
+from flask import current_app, request, url_for, send_from_directory, abort
+
+logger = logging.getLogger('application')
+
+# written by build_assets.py, see there for the layout
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+# hashed names never change content, so browsers may keep them for a year without revalidating
+MAX_AGE = 31536000
+IMMUTABLE_CACHE = 'public, max-age={}, immutable'.format(MAX_AGE)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')] # preferred first
+
+class Assets(object):
+    ''' Resolves and serves the fingerprinted static files, falling back to plain /static without a build '''
+
+    def __init__(self):
+        self.manifest = None
+        self.directory = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+
+    def _load(self):
+        # read on first use, the static folder may be repointed after the app is created
+        with self._lock:
+            if self.manifest is not None:
+                return
+            self.directory = os.path.join(current_app.static_folder, BUILD_DIR)
+            try:
+                with open(os.path.join(self.directory, MANIFEST)) as f:
+                    manifest = json.load(f)
+                logger.info('Serving %d fingerprinted assets from %s', len(manifest), self.directory)
+            except FileNotFoundError:
+                logger.info('No asset build in %s, serving static files unhashed', self.directory)
+                manifest = {}
+            self.files = frozenset(manifest.values())
+            self.manifest = manifest
+
+    def url(self, filename):
+        if self.manifest is None:
+            self._load()
+        hashed = self.manifest.get(filename)
+        if hashed is None:
+            return url_for('static', filename = filename)
+        return url_for('assets', filename = hashed)
+
+    def serve(self, filename):
+        if self.manifest is None:
+            self._load()
+        if filename not in self.files:
+            abort(404)
+        for encoding, ext in ENCODINGS + [(None, '')]:
+            if encoding is None or (request.accept_encodings[encoding] and os.path.exists(os.path.join(self.directory, filename + ext))):
+                break
+        response = send_from_directory(self.directory, filename + ext, max_age = MAX_AGE,
+                                       mimetype = mimetypes.guess_type(filename)[0])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE
+        return response
+
+assets = Assets()
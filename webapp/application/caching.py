@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import time
+import threading
+from collections import OrderedDict
+
+class LRUTTLCache(object):
+    '''
+    Thread-safe dict-like cache bounded by size (least recently used entries evicted first)
+    and by age (entries older than ttl seconds are reloaded). Counts hits, misses and evictions.
+    '''
+
+    def __init__(self, maxsize = 1024, ttl = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            if entry is not None:
+                del self._data[key]
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+                self.evictions += 1
+
+    def get_or_load(self, key, load):
+        ''' Cached value, or load() it and cache the result unless it is None '''
+        value = self.get(key)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
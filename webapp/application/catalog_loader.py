@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+'''
+Loads the rules catalog (playbooks, moves, techniques) from content files into the database.
+
+A content directory holds playbooks, moves and techniques files, each as .json (a list of objects) or .csv
+(a header row of column names; JSON columns such as history_questions hold JSON text). Keys are the model
+columns. id may be left out, it then derives from name. Moves and techniques may name their playbook with
+"playbook" instead of giving playbook_id.
+
+Everything is validated against the enums in db_model before anything is written, then upserted in bulk
+inside one transaction that also bumps the catalog version. A checksum of the content is stored in
+catalog_version, so loading unchanged content again does nothing. Rows missing from the files are left in place,
+since characters may still reference them.
+'''
+
+import os
+import csv
+import json
+import hashlib
+import logging
+from hashlib import md5
+from datetime import datetime
+from sqlalchemy import select, bindparam
+
+from . import db
+from .db_model import (Playbook, Move, Technique, CatalogVersion, catalog, bump_catalog_version, column_problem,
+                       move_types, statistics, approaches, trainings)
+
+logger = logging.getLogger('application')
+
+LOAD_BATCH_SIZE = 500
+
+# model, file stem, {column: allowed values}, in foreign key order
+TABLES = [
+    (Playbook, 'playbooks', {}),
+    (Move, 'moves', {'move_type': move_types, 'statistic': statistics}),
+    (Technique, 'techniques', {'technique_type': ['Basic', 'Advanced'], 'approach': approaches,
+                               'req_training': ['Universal'] + trainings}),
+]
+
+class CatalogError(ValueError):
+    ''' Content failed validation, carries every problem found '''
+
+    def __init__(self, errors):
+        super(CatalogError, self).__init__('{} catalog errors:\n  {}'.format(len(errors), '\n  '.join(errors)))
+        self.errors = errors
+
+def make_id(name):
+    return md5(name.encode()).hexdigest()
+
+def _read(path):
+    if path.endswith('.json'):
+        with open(path) as f:
+            records = json.load(f)
+        if not isinstance(records, list):
+            raise CatalogError(['{}: expected a list of objects'.format(path)])
+        return records
+    with open(path, newline = '') as f:
+        return list(csv.DictReader(f))
+
+def read_dir(path):
+    ''' {file stem: records} for the content files found in a directory '''
+    content = {}
+    for _, stem, _ in TABLES:
+        for ext in ('.json', '.csv'):
+            f = os.path.join(path, stem + ext)
+            if os.path.exists(f):
+                content[stem] = _read(f)
+                break
+    return content
+
+def _coerce(column, value):
+    ''' CSV cells arrive as strings, JSON values as parsed; both end up as the column's python type '''
+    if value == '' or value is None:
+        return None
+    t = column.type
+    if isinstance(t, db.JSON):
+        return json.loads(value) if isinstance(value, str) else value
+    if isinstance(t, db.Boolean):
+        if isinstance(value, str):
+            if value.lower() not in ('true', 'false', '1', '0', 'yes', 'no'):
+                raise ValueError('not a boolean')
+            return value.lower() in ('true', '1', 'yes')
+        return bool(value)
+    if isinstance(t, (db.Integer, db.SmallInteger)):
+        return int(value)
+    return str(value)
+
+def normalize(content, playbook_ids = None):
+    '''
+    Validated rows per model, every column present, in a stable order. playbook_ids ({name: id}) are playbooks
+    already in the database that moves and techniques may reference. Raises CatalogError listing all problems
+    '''
+    errors = []
+    rows = {}
+    playbook_ids = dict(playbook_ids or {})
+    for model, stem, enums in TABLES:
+        columns = {c.key: c for c in model.__table__.columns}
+        table_rows = {}
+        for n, record in enumerate(content.get(stem, []), 1):
+            where = '{}[{}]'.format(stem, n)
+            if not isinstance(record, dict):
+                errors.append('{}: not an object'.format(where))
+                continue
+            record = dict(record)
+            name = record.pop('playbook', None) if model is not Playbook else None
+            if name:
+                if name not in playbook_ids:
+                    errors.append('{}: unknown playbook {}'.format(where, name))
+                record['playbook_id'] = playbook_ids.get(name)
+            unknown = [k for k in record if k not in columns]
+            if unknown:
+                errors.append('{}: unknown columns {}'.format(where, ', '.join(unknown)))
+                continue
+            row = {}
+            for k, column in columns.items():
+                try:
+                    row[k] = _coerce(column, record.get(k))
+                except ValueError as e:
+                    row[k] = None
+                    errors.append('{}: bad {} {!r} ({})'.format(where, k, record.get(k), e))
+            if not row['name']:
+                errors.append('{}: name is required'.format(where))
+                continue
+            row['id'] = row['id'] or make_id(row['name'])
+            for k, allowed in enums.items():
+                if row[k] is not None and row[k] not in allowed:
+                    errors.append('{}: {} must be one of {}, not {!r}'.format(where, k, ', '.join(allowed), row[k]))
+            for k, column in columns.items(): # lengths, integer ranges and JSON shapes, as characters get
+                problem = column_problem(column, row[k]) if row[k] is not None and k not in enums else None
+                if problem:
+                    errors.append('{}: {} {}'.format(where, k, problem))
+            if row.get('playbook_id') and row['playbook_id'] not in playbook_ids.values():
+                errors.append('{}: unknown playbook_id {}'.format(where, row['playbook_id']))
+            if row['id'] in table_rows:
+                errors.append('{}: duplicate id {} ({})'.format(where, row['id'], row['name']))
+            table_rows[row['id']] = row
+        if model is Playbook:
+            playbook_ids.update({r['name']: i for i, r in table_rows.items()})
+        rows[model] = [table_rows[i] for i in sorted(table_rows)]
+    if errors:
+        raise CatalogError(errors)
+    return rows
+
+def checksum(rows):
+    canonical = json.dumps([[m.__tablename__, r] for m, model_rows in rows.items() for r in model_rows],
+                           sort_keys = True, separators = (',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def _chunks(rows, size):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+def load(content, force = False, batch_size = LOAD_BATCH_SIZE):
+    '''
+    Validate and upsert content ({file stem: records}). Returns {'changed': bool, 'checksum': ..., 'inserted'/'updated':
+    {table: n}}. Does nothing when the stored checksum already matches, unless force
+    '''
+    stamp = CatalogVersion.__table__
+    with db.engine.begin() as conn:
+        playbooks = Playbook.__table__
+        rows = normalize(content, {r.name: r.id for r in conn.execute(select(playbooks.c.name, playbooks.c.id))})
+        digest = checksum(rows)
+        result = {'changed': False, 'checksum': digest, 'inserted': {}, 'updated': {}}
+        current = conn.execute(select(stamp.c.checksum).where(stamp.c.id == 1)).first()
+        if current and current.checksum == digest and not force:
+            logger.info('Catalog content unchanged (%s), nothing to load', digest[:12])
+            return result
+        for model, model_rows in rows.items():
+            table = model.__table__
+            existing = {r.id: dict(r._mapping) for r in conn.execute(select(table))}
+            new = [r for r in model_rows if r['id'] not in existing]
+            changed = [r for r in model_rows if r['id'] in existing and existing[r['id']] != r]
+            for chunk in _chunks(new, batch_size):
+                conn.execute(table.insert(), chunk)
+            if changed:
+                update = table.update().where(table.c.id == bindparam('_id')).values(
+                    {c: bindparam(c) for c in changed[0] if c != 'id'})
+                for chunk in _chunks(changed, batch_size):
+                    conn.execute(update, [dict(r, _id = r['id']) for r in chunk])
+            result['inserted'][table.name] = len(new)
+            result['updated'][table.name] = len(changed)
+        if current:
+            bump_catalog_version(conn, checksum = digest)
+        else:
+            conn.execute(stamp.insert().values(id = 1, version = 1, checksum = digest, updated_at = datetime.utcnow()))
+    catalog.invalidate() # other processes notice the version bump on their next check
+    result['changed'] = True
+    logger.info('Loaded catalog %s: inserted %s, updated %s', digest[:12], result['inserted'], result['updated'])
+    return result
+
+def load_dir(path, force = False):
+    content = read_dir(path)
+    if not content:
+        logger.warning('No catalog files in %s', path)
+        return None
+    return load(content, force)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import os
+import zlib
+from flask import request
+
+from . import metrics
+
+try: # optional, gzip only without it
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies smaller than this go out as they are, compressing them costs more than it saves
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6)) # gzip, 1-9
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4)) # 0-11, above ~5 is for build time
+COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/x-ndjson',
+                      'application/javascript', 'text/javascript', 'image/svg+xml'}
+
+compressed_bytes = metrics.Counter('avatar_compression_bytes_total', 'Response bytes before and after compression',
+                                   ['encoding', 'stage'])
+metrics.metrics_.append(compressed_bytes)
+
+def negotiate():
+    ''' Best content-coding the client accepts, br over gzip at equal quality, or None '''
+    accept = request.accept_encodings
+    options = [(accept['gzip'], 1, 'gzip')]
+    if brotli is not None:
+        options.append((accept['br'], 2, 'br'))
+    quality, _, encoding = max(options)
+    return encoding if quality > 0 else None
+
+def compressor(encoding):
+    ''' Object with compress(bytes) and flush(), for one response '''
+    if encoding == 'br':
+        c = brotli.Compressor(quality = COMPRESS_BROTLI_QUALITY)
+        return _Brotli(c)
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31) # wbits 16 + 15 writes a gzip container
+
+class _Brotli(object):
+
+    def __init__(self, c):
+        self.c = c
+
+    def compress(self, data):
+        return self.c.process(data)
+
+    def flush(self):
+        return self.c.finish()
+
+def _stream(chunks, c, encoding):
+    ''' Compress a streamed body chunk by chunk, so large exports never sit in memory whole '''
+    size_in = size_out = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            size_in += len(chunk)
+            out = c.compress(chunk)
+            if out:
+                size_out += len(out)
+                yield out
+        out = c.flush()
+        size_out += len(out)
+        yield out
+    finally:
+        compressed_bytes.inc(size_in, (encoding, 'in'))
+        compressed_bytes.inc(size_out, (encoding, 'out'))
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def _skip(response):
+    return (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough # files, see assets.py for precompressed ones
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES
+            or 'no-transform' in response.headers.get('Cache-Control', '')
+            or request.method == 'HEAD')
+
+def _after_request(response):
+    if _skip(response):
+        return response
+    response.vary.add('Accept-Encoding') # whether or not this one was compressed, the choice depends on it
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _stream(response.response, compressor(encoding), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        c = compressor(encoding)
+        body = c.compress(data) + c.flush()
+        compressed_bytes.inc(len(data), (encoding, 'in'))
+        compressed_bytes.inc(len(body), (encoding, 'out'))
+        response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def init_app(app):
+    app.after_request(_after_request)
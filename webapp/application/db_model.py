@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 
+import os
 import json
+import time
 import logging
+import threading
+from types import MappingProxyType
 from datetime import datetime
 from hashlib import md5
+from flask import abort
 from flask_login import UserMixin
-from sqlalchemy.sql.expression import and_, or_, not_
+from sqlalchemy import select, event
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.associationproxy import association_proxy
 
 from . import db
+from .serialize import serializer_for, PreparedBody
+from .caching import LRUTTLCache
+from .passwords import hasher
 
 logger = logging.getLogger('db_model')
 
@@ -19,44 +31,256 @@ trainings = ['Waterbending','Airbending','Firebending','Earthbending','Weapons',
 move_types = ['Basic','Balance','Playbook','Advancement','Custom']
 statistics = ['Creativity','Focus','Harmony','Passion']
 approaches = ['Defend and Maneuver','Advance and Attack','Evade and Observe']
+masteries = ['Basic','Learned','Practiced','Mastered']
+
+# seconds between checks of the catalog version stamp
+CATALOG_CHECK_INTERVAL = float(os.environ.get('CATALOG_CHECK_INTERVAL', 60))
+# flask-login identity cache, see Player.get_identity
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+
+# default loader strategy per relationship (select = lazy, selectin, joined, raise, ...).
+# routes add eager load options per query on top of these, override with e.g.
+# RELATIONSHIP_LOADING='Character.playbook=joined,Player.characters=selectin'
+relationship_loading = {
+    'Playbook.moves': 'select',
+    'Playbook.technique': 'select',
+    'Move.playbook': 'select',
+    'Technique.playbook': 'select',
+    'Character.player': 'select',
+    'Character.playbook': 'select',
+    'Character.moves': 'select',
+    'Character.techniques': 'select',
+    'Character.move_rows': 'select',
+    'Character.technique_rows': 'select',
+    'Player.characters': 'select',
+}
+for setting in filter(None, os.environ.get('RELATIONSHIP_LOADING', '').split(',')):
+    rel, strategy = setting.split('=')
+    if rel not in relationship_loading:
+        raise KeyError('Unknown relationship in RELATIONSHIP_LOADING: {}'.format(rel))
+    relationship_loading[rel] = strategy
 
 def stat_str(s):
     return str(s) if s <= 0 else '+'+str(s)
 
+class CatalogSnapshot(object):
+    '''
+    Immutable, indexed copy of the rules catalog (playbooks, moves, techniques) at one version.
+    Rows are detached model instances and should be treated as read-only.
+    '''
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.by_id = MappingProxyType({cls: MappingProxyType({r.id: r for r in rs}) for cls, rs in rows.items()})
+        self.by_name = MappingProxyType({cls: MappingProxyType({r.name: r for r in rs}) for cls, rs in rows.items()})
+        self.all = MappingProxyType({cls: tuple(rs) for cls, rs in rows.items()})
+        self.moves_by_type = self._group(rows[Move], 'move_type')
+        self.moves_by_playbook = self._group(rows[Move], 'playbook_id')
+        self.techniques_by_type = self._group(rows[Technique], 'technique_type')
+        self.techniques_by_playbook = self._group(rows[Technique], 'playbook_id')
+        self.bodies = {} # pre-serialized API responses for this version, see CatalogCache.prepared
+        self.derived = {} # other values computed from this version, see CatalogCache.memo
+        self.eligible_techniques = MappingProxyType({
+            (p.id, training): self._eligible(p.id, training) for p in rows[Playbook] for training in [None] + trainings
+        })
+
+    def _eligible(self, playbook_id, training):
+        '''
+        Advanced techniques open to a character with this playbook and training. Matches the query this replaced:
+        playbook_id == None compiled to IS NULL there, but a None training in IN ('Universal', NULL) matched nothing
+        '''
+        return tuple(t for t in self.techniques_by_type.get('Advanced', ())
+                    if t.playbook_id == playbook_id or t.req_training == 'Universal'
+                    or (training is not None and t.req_training == training))
+
+    @staticmethod
+    def _group(rows, attr):
+        groups = {}
+        for r in rows:
+            groups.setdefault(getattr(r, attr), []).append(r)
+        return MappingProxyType({k: tuple(v) for k, v in groups.items()})
+
+class CatalogCache(object):
+    '''
+    In-process cache of the catalog tables. Loads everything once and reloads only when the
+    version stamp in catalog_version changes, which is checked at most every CATALOG_CHECK_INTERVAL seconds.
+    '''
+
+    def __init__(self, check_interval = CATALOG_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def classes(self):
+        return (Playbook, Move, Technique)
+
+    def _read_version(self):
+        try:
+            with db.engine.connect() as conn:
+                return conn.execute(select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar()
+        except (OperationalError, ProgrammingError):
+            logger.warning('No catalog_version table, run python -m application.migrations upgrade')
+            return None
+
+    def _load(self, version):
+        # separate session so cached rows never share an identity map with request sessions
+        session = Session(bind = db.engine)
+        try:
+            rows = {cls: session.query(cls).all() for cls in self.classes}
+        finally:
+            session.close()
+        logger.info('Loaded catalog version %s', version)
+        return CatalogSnapshot(version, rows)
+
+    def snapshot(self):
+        snap = self._snapshot
+        now = time.monotonic()
+        if snap is not None and now - self._checked_at < self.check_interval:
+            return snap
+        with self._lock:
+            if self._snapshot is not snap: # another thread refreshed while we waited
+                return self._snapshot
+            version = self._read_version()
+            if snap is None or version != snap.version:
+                snap = self._load(version)
+                self._snapshot = snap
+            self._checked_at = now
+        return snap
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def get(self, cls, id):
+        return self.snapshot().by_id[cls].get(id)
+
+    def get_name(self, cls, name):
+        return self.snapshot().by_name[cls].get(name)
+
+    def get_all(self, cls):
+        return list(self.snapshot().all[cls])
+
+    def prepared(self, key, build):
+        '''
+        Pre-serialized body for key at the current catalog version. build() returns JSON bytes, or None if
+        there is nothing to serve, and is only called once per version.
+        '''
+        snap = self.snapshot()
+        prepared = snap.bodies.get(key)
+        if prepared is None:
+            body = build()
+            if body is None:
+                return None
+            prepared = snap.bodies.setdefault(key, PreparedBody(body))
+        return prepared
+
+    def memo(self, key, build):
+        ''' build() once per key per catalog version, for values that depend only on the catalog '''
+        snap = self.snapshot()
+        value = snap.derived.get(key)
+        if value is None:
+            value = snap.derived.setdefault(key, build())
+        return value
+
+    def eligible_techniques(self, playbook_id, training):
+        snap = self.snapshot()
+        t = snap.eligible_techniques.get((playbook_id, training))
+        return t if t is not None else snap._eligible(playbook_id, training)
+
+catalog = CatalogCache()
+
+def bump_catalog_version(conn, **values):
+    '''
+    Call in the same transaction as any change to playbooks, moves or techniques. conn is a session or connection,
+    values are stored alongside (e.g. checksum)
+    '''
+    t = CatalogVersion.__table__
+    conn.execute(t.update().where(t.c.id == 1).values(version = t.c.version + 1, updated_at = datetime.utcnow(), **values))
+
 class DbMixIn(object):
     ''' Base class for project database models '''
 
     protected_columns_ = []
+    cached_ = False # served from the in-process catalog cache
+    list_filters_ = [] # columns list_rows may filter on, keep these indexed
+    page_size_ = 100
+    max_page_size_ = 1000
 
     @classmethod
-    def get(cls, id): # this is apparently implemented natively?
-        return cls.query.filter_by(id = id).first()
+    def get(cls, id, options = None): # this is apparently implemented natively?
+        ''' options are query load options, e.g. [joinedload(Character.playbook)], ignored for cached classes '''
+        if cls.cached_:
+            return catalog.get(cls, id)
+        return cls.query.options(*(options or [])).filter_by(id = id).first()
 
     @classmethod
     def get_or_404(cls, id):
+        if cls.cached_:
+            obj = catalog.get(cls, id)
+            if obj is None:
+                abort(404)
+            return obj
         return cls.query.filter_by(id = id).first_or_404()
 
     @classmethod
-    def get_name(cls, name): # might want to construct an index on name fields if this is used a lot
+    def get_name(cls, name): # players and playbooks have unique indexes on name
+        if cls.cached_:
+            return catalog.get_name(cls, name)
         return cls.query.filter_by(name = name).first()
 
     @classmethod
     def get_all(cls):
+        if cls.cached_:
+            return catalog.get_all(cls)
         return cls.query.all()
 
+    @classmethod
+    def list_rows(cls, filters = None, fields = None, ids = None, after = None, limit = None):
+        '''
+        Keyset-paginated listing ordered by id, selecting only the requested fields.
+        filters maps whitelisted columns to a value or list of values. Returns (rows as dicts, next cursor or None).
+        Raises ValueError for unknown fields or filters.
+        '''
+        filters = filters or {}
+        bad = [k for k in filters if k not in cls.list_filters_]
+        if bad:
+            raise ValueError('Cannot filter on: {}'.format(', '.join(bad)))
+        serializer = serializer_for(cls, fields)
+        select_fields = serializer.fields if 'id' in serializer.fields else ('id',) + serializer.fields
+        try:
+            limit = min(int(limit or cls.page_size_), cls.max_page_size_)
+        except ValueError:
+            raise ValueError('limit must be an integer')
+        if limit < 1:
+            raise ValueError('limit must be positive')
+
+        q = db.session.query(*[cls.__table__.c[f] for f in select_fields])
+        for k, v in filters.items():
+            col = cls.__table__.c[k]
+            q = q.filter(col.in_(v) if isinstance(v, (list, tuple)) else col == v)
+        if ids is not None:
+            q = q.filter(cls.id.in_(ids))
+        if after:
+            q = q.filter(cls.id > after)
+        rows = q.order_by(cls.id).limit(limit + 1).all()
+        next_cursor = rows[limit - 1].id if len(rows) > limit else None
+        return serializer.to_dicts(rows[:limit]), next_cursor
+
     @property
     def columns(self):
-        cols = [c.key for c in self.__table__.columns]
-        return cols
+        return serializer_for(type(self)).fields
 
     @property
     def mutable_columns(self):
-        cols = [c.key for c in self.__table__.columns if c.key not in self.protected_columns_]
+        cols = [c for c in self.columns if c not in self.protected_columns_]
         return cols
 
-    def to_dict(self): # , extra_attrs = []
-        conv_ts = lambda v: v.strftime('%Y-%m-%d %H:%M:%S') if isinstance(v, datetime) else v
-        return {k: conv_ts(v) for k,v in self.__dict__.items() if k in self.columns}
+    def to_dict(self, fields = None):
+        return serializer_for(type(self), fields).to_dict(self)
 
     def __init__(self, **kwargs):
         super(DbMixIn, self).__init__(**kwargs)
@@ -83,6 +307,7 @@ class Playbook(db.Model, DbMixIn):
     ;
     '''
     __tablename__ = 'playbooks'
+    __table_args__ = (db.Index('ux_playbooks_name', 'name', unique = True),)
     id = db.Column(db.String(32), primary_key = True, nullable = False)
     name = db.Column(db.String(100), nullable = False)
     creativity = db.Column(db.SmallInteger)
@@ -97,9 +322,10 @@ class Playbook(db.Model, DbMixIn):
     moment_of_balance = db.Column(db.String(1024))
     growth_question = db.Column(db.String(255))
 
-    moves = db.relationship('Move', viewonly = True)
-    technique = db.relationship('Technique', viewonly = True, uselist = False)
+    moves = db.relationship('Move', viewonly = True, lazy = relationship_loading['Playbook.moves'])
+    technique = db.relationship('Technique', viewonly = True, uselist = False, lazy = relationship_loading['Playbook.technique'])
 
+    cached_ = True
     protected_columns_ = ['id','name','creativity','focus','harmony',
                         'passion','principle_1','principle_2','history_questions',
                         'connections','moment_of_balance','growth_question']
@@ -138,6 +364,11 @@ class Move(db.Model, DbMixIn):
     ;
     '''
     __tablename__ = 'moves'
+    __table_args__ = (
+        db.Index('ix_moves_move_type', 'move_type'),
+        db.Index('ix_moves_playbook_id', 'playbook_id'),
+        db.Index('ix_moves_statistic', 'statistic')
+    )
     id = db.Column(db.String(32), primary_key = True, nullable = False)
     name = db.Column(db.String(100), nullable = False)
     move_type = db.Column(db.Enum(*move_types))
@@ -148,13 +379,19 @@ class Move(db.Model, DbMixIn):
     weak_hit_outcome = db.Column(db.String(255))
     strong_hit_outcome = db.Column(db.String(255))
 
-    playbook = db.relationship('Playbook', back_populates = 'moves', uselist = False)
+    playbook = db.relationship('Playbook', back_populates = 'moves', uselist = False, lazy = relationship_loading['Move.playbook'])
 
+    cached_ = True
+    list_filters_ = ['move_type','playbook_id','statistic']
     protected_columns_ = ['id','name','move_type','playbook','statistic',
                         'description','miss_outcome','weak_hit_outcome','strong_hit_outcome']
 
     def starting_moves():
-        return Move.query.filter(Move.move_type.in_(['Basic','Balance','Advancement'])).all()
+        by_type = catalog.snapshot().moves_by_type
+        return [m for t in ['Basic','Balance','Advancement'] for m in by_type.get(t, ())]
+
+    def playbook_moves(playbook_id):
+        return list(catalog.snapshot().moves_by_playbook.get(playbook_id, ()))
 
     def __init__(self, **kwargs):
         super(Move, self).__init__(**kwargs)
@@ -181,6 +418,12 @@ class Technique(db.Model, DbMixIn):
     ;
     '''
     __tablename__ = 'techniques'
+    __table_args__ = (
+        db.Index('ix_techniques_type_training', 'technique_type', 'req_training'),
+        db.Index('ix_techniques_req_training', 'req_training'),
+        db.Index('ix_techniques_playbook_id', 'playbook_id'),
+        db.Index('ix_techniques_approach', 'approach')
+    )
     id = db.Column(db.String(32), primary_key = True, nullable = False)
     name = db.Column(db.String(100), nullable = False)
     technique_type = db.Column(db.Enum(*['Basic','Advanced']))
@@ -202,18 +445,49 @@ class Technique(db.Model, DbMixIn):
     # https://stackoverflow.com/questions/7417906/sqlalchemy-manytomany-secondary-table-with-additional-fields
     # mastery = association_proxy('technique_mastery', 'character_mastery')
 
-    playbook = db.relationship('Playbook', back_populates = 'technique', uselist = False)
+    playbook = db.relationship('Playbook', back_populates = 'technique', uselist = False, lazy = relationship_loading['Technique.playbook'])
 
+    cached_ = True
+    list_filters_ = ['technique_type','approach','req_training','playbook_id']
     protected_columns_ = ['id','name','technique_type','approach','req_training','req_playbook',
                         'description','cost','fatigue_cleared','conditions_cleared',
                         'fatigue_inflicted','conditions_inflicted','is_blockable','is_rare']
 
     def starting_techniques():
-        return Technique.query.filter(Technique.technique_type == 'Basic').all()
+        return list(catalog.snapshot().techniques_by_type.get('Basic', ()))
 
     def __init__(self, **kwargs):
         super(Technique, self).__init__(**kwargs)
 
+class StaleCharacter(Exception):
+    ''' The character changed since it was loaded '''
+
+# signed ranges of the integer types, subclasses before Integer. strict MySQL refuses values outside them
+INTEGER_RANGES = [(db.SmallInteger, -2 ** 15, 2 ** 15 - 1), (db.BigInteger, -2 ** 63, 2 ** 63 - 1),
+                  (db.Integer, -2 ** 31, 2 ** 31 - 1)]
+
+def column_problem(column, value):
+    ''' Why value cannot be stored in column, or None if it can '''
+    t = column.type
+    if value is None:
+        return None if column.nullable else 'is required'
+    if isinstance(t, db.Enum): # before String, which it extends
+        return None if value in t.enums else 'must be one of {}'.format(', '.join(t.enums))
+    if isinstance(t, db.Boolean):
+        return None if isinstance(value, bool) else 'must be true or false'
+    if isinstance(t, db.Integer):
+        if not isinstance(value, int) or isinstance(value, bool):
+            return 'must be a whole number'
+        low, high = next((low, high) for kind, low, high in INTEGER_RANGES if isinstance(t, kind))
+        return None if low <= value <= high else 'must be between {} and {}'.format(low, high)
+    if isinstance(t, db.String):
+        if isinstance(value, str) and (t.length is None or len(value) <= t.length):
+            return None
+        return 'must be text of at most {} characters'.format(t.length)
+    if isinstance(t, db.JSON): # demeanors, history_questions, connections
+        return None if isinstance(value, list) and all(isinstance(v, str) for v in value) else 'must be a list of text'
+    return None
+
 class Character(db.Model, DbMixIn):
     '''
     CREATE TABLE characters (
@@ -249,6 +523,7 @@ class Character(db.Model, DbMixIn):
     ;
     '''
     __tablename__ = 'characters'
+    __table_args__ = (db.Index('ux_characters_player_name', 'player_id', 'name', unique = True),)
     player_id = db.Column(db.String(32), db.ForeignKey('players.id'), nullable = False)
     id = db.Column(db.String(32), primary_key = True, nullable = False)
     name = db.Column(db.String(255), nullable = False)
@@ -276,14 +551,21 @@ class Character(db.Model, DbMixIn):
     growth_advancements = db.Column(db.SmallInteger, default = 0)
     mob_unlocked = db.Column(db.Boolean, default = False)
     created_at = db.Column(db.DateTime, default = datetime.utcnow)
-    updated_at = db.Column(db.DateTime, onupdate = datetime.utcnow)
-
-    player = db.relationship('Player', back_populates = 'characters', uselist = False)
-    playbook = db.relationship('Playbook', viewonly = True, uselist = False)
-    moves = db.relationship('Move', secondary = lambda: CharacterMove.__table__, viewonly = True)
-    techniques = db.relationship('Technique', secondary = lambda: CharacterTechnique.__table__, viewonly = True)
-
-    protected_columns_ = ['player_id','id','name']
+    # also the row version, see etag. microseconds must survive the round trip or If-Match never matches again,
+    # so MySQL gets TIMESTAMP(6) here as well as in migration 6 for tables made by create_all
+    updated_at = db.Column(mysql.TIMESTAMP(fsp = 6), default = datetime.utcnow, onupdate = datetime.utcnow)
+
+    player = db.relationship('Player', back_populates = 'characters', uselist = False, lazy = relationship_loading['Character.player'])
+    playbook = db.relationship('Playbook', viewonly = True, uselist = False, lazy = relationship_loading['Character.playbook'])
+    moves = db.relationship('Move', secondary = lambda: CharacterMove.__table__, viewonly = True,
+                            lazy = relationship_loading['Character.moves'])
+    techniques = db.relationship('Technique', secondary = lambda: CharacterTechnique.__table__, viewonly = True,
+                                 lazy = relationship_loading['Character.techniques'])
+    # join rows, resolved against the catalog cache instead of joining moves/techniques
+    move_rows = db.relationship('CharacterMove', viewonly = True, lazy = relationship_loading['Character.move_rows'])
+    technique_rows = db.relationship('CharacterTechnique', viewonly = True, lazy = relationship_loading['Character.technique_rows'])
+
+    protected_columns_ = ['player_id','id','name','created_at','updated_at']
 
     @property
     def stats(self):
@@ -307,84 +589,242 @@ class Character(db.Model, DbMixIn):
     def filled_connections(self):
         return [q.replace('$BLANK$', a) for q, a in zip(self.playbook.connections, self.connections)]
 
-    def available_techniques(self, include_known = False):
+    def available_techniques(self, include_known = False, known_ids = None):
+        t = catalog.eligible_techniques(self.playbook_id, self.training)
         if include_known:
-            t = Technique.query.filter(
-                    and_(Technique.technique_type == 'Advanced', 
-                    or_(Technique.playbook_id == self.playbook_id, Technique.req_training.in_(['Universal', self.training])))
-                ).all()
-        else: 
-            t = Technique.query.filter(
-                    and_(Technique.technique_type == 'Advanced', 
-                    or_(Technique.playbook_id == self.playbook_id, Technique.req_training.in_(['Universal', self.training])),
-                    not_(Technique.id.in_([t.id for t in self.techniques])))
-                ).all()
-        return t
-
-    def _set_creation_stat(self, value):
-        prev = self.creation_stat_increase
-        if prev and prev != value:
-            self.set(prev.lower(), self.stats[prev] - 1)
-        self.creation_stat_increase = value
-        self.set(value.lower(), self.stats[value] + 1)
-
-    def _set_creation_moves(self, value, session):
-        if not session:
-            raise ValueError('Session must be passed to Character.set() to update moves and techniques')
-        prev = self.creation_moves
-        if prev:
-            new = [m for m in value if m not in prev]
-            removed = [m for m in prev if m not in value]
-        else:
-            new = value 
-            removed = []
-        for move_id in new:
-            cm = CharacterMove(self.id, move_id)
-            session.add(cm)
-        for move_id in removed:
-            cm = CharacterMove.get(self.id, move_id)
-            session.delete(cm)
-        self.creation_moves = value
-
-    def _set_creation_techniques(self, value, session):
-        if not session:
-            raise ValueError('Session must be passed to Character.set() to update moves and techniques')
-        l = value[0]
-        m = value[1]
-        dict_value = {'Learned': l, 'Mastered': m}
-        if self.creation_techniques:
-            prev_l = self.creation_techniques['Learned']
-            prev_m = self.creation_techniques['Mastered']
-            if l != prev_l:
-                del_ct = CharacterTechnique.get(self.id, prev_l)
-                session.delete(del_ct)
-            if m != prev_m:
-                del_ct = CharacterTechnique.get(self.id, prev_m)
-                session.delete(del_ct)   
-        self.creation_techniques = dict_value
-        ctl = CharacterTechnique(self.id, l, mastery = 'Learned')
-        ctm = CharacterTechnique(self.id, m, mastery = 'Mastered')
-        session.add(ctl)
-        session.add(ctm)
-    
+            return list(t)
+        if known_ids is None:
+            known_ids = {k.id for k in self.techniques}
+        return [x for x in t if x.id not in known_ids]
+
+    def available_techniques_for(characters, include_known = False):
+        ''' Batch version of available_techniques keyed by character id. Known techniques take one query for all characters '''
+        known = {c.id: set() for c in characters}
+        if not include_known and known:
+            rows = db.session.query(CharacterTechnique.character_id, CharacterTechnique.technique_id).filter(
+                CharacterTechnique.character_id.in_(list(known))
+            )
+            for character_id, technique_id in rows:
+                known[character_id].add(technique_id)
+        return {c.id: c.available_techniques(include_known, known_ids = known[c.id]) for c in characters}
+
+    @classmethod
+    def check_changes(cls, changes):
+        '''
+        {field: problem} for values in changes (as passed to apply_changes) that do not fit their column or name
+        catalog rows that do not exist. Empty when everything can be applied
+        '''
+        errors = {}
+        columns = cls.__table__.columns
+        for attr, value in changes.items():
+            if attr == 'creation_moves':
+                if not isinstance(value, list) or not all(isinstance(m, str) for m in value):
+                    errors[attr] = 'must be a list of move ids'
+                elif len(set(value)) != len(value):
+                    errors[attr] = 'lists a move more than once'
+                elif any(not Move.get(m) for m in value):
+                    errors[attr] = 'unknown moves {}'.format(', '.join(m for m in value if not Move.get(m)))
+            elif attr == 'creation_techniques':
+                if isinstance(value, (list, tuple)) and len(value) == 2:
+                    value = {'Learned': value[0], 'Mastered': value[1]}
+                if not isinstance(value, dict) or not all(isinstance(t, str) for t in value.values()):
+                    errors[attr] = 'must map masteries to technique ids'
+                elif any(k not in masteries for k in value):
+                    errors[attr] = 'masteries must be among {}'.format(', '.join(masteries))
+                elif len(set(value.values())) != len(value):
+                    errors[attr] = 'a technique can only have one mastery'
+                elif any(not Technique.get(t) for t in value.values()):
+                    errors[attr] = 'unknown techniques {}'.format(', '.join(t for t in value.values() if not Technique.get(t)))
+            elif attr == 'creation_stat_increase' and value is None:
+                errors[attr] = 'is required'
+            elif attr == 'playbook_id' and value is not None and not (isinstance(value, str) and Playbook.get(value)):
+                errors[attr] = 'unknown playbook'
+            elif attr in columns:
+                problem = column_problem(columns[attr], value)
+                if problem:
+                    errors[attr] = problem
+        return errors
+
+    def _diff(self, changes):
+        '''
+        Compare changes against the loaded state. Returns (column updates, move ids to delete, move rows to insert,
+        technique ids to delete, technique rows to insert); unchanged fields produce nothing
+        '''
+        updates = {}
+        move_deletes, move_inserts, technique_deletes, technique_inserts = set(), [], set(), []
+        current = lambda attr: updates.get(attr, getattr(self, attr))
+        for attr, value in changes.items():
+            if attr == 'creation_stat_increase':
+                prev = self.creation_stat_increase
+                if value == prev:
+                    continue
+                if prev:
+                    updates[prev.lower()] = (current(prev.lower()) or 0) - 1
+                updates[value.lower()] = (current(value.lower()) or 0) + 1
+                updates[attr] = value
+            elif attr == 'creation_moves':
+                prev = self.creation_moves or []
+                value = list(value)
+                if value == prev:
+                    continue
+                added = [m for m in value if m not in prev]
+                # added ids are deleted too so a move the character already had is replaced, not duplicated
+                move_deletes.update([m for m in prev if m not in value] + added)
+                move_inserts.extend({'character_id': self.id, 'move_id': m} for m in added)
+                updates[attr] = value
+            elif attr == 'creation_techniques':
+                value = value if isinstance(value, dict) else {'Learned': value[0], 'Mastered': value[1]}
+                prev = self.creation_techniques or {}
+                if value == prev:
+                    continue
+                for mastery, technique_id in value.items():
+                    if prev.get(mastery) == technique_id:
+                        continue
+                    if prev.get(mastery):
+                        technique_deletes.add(prev[mastery])
+                    technique_deletes.add(technique_id)
+                    technique_inserts.append({'character_id': self.id, 'technique_id': technique_id, 'mastery': mastery})
+                updates[attr] = value
+            elif current(attr) != value:
+                updates[attr] = value
+        return updates, move_deletes, move_inserts, technique_deletes, technique_inserts
+
+    @property
+    def etag(self):
+        ''' Version of the row for If-Match, changes on every update '''
+        return '"{}"'.format(self.updated_at.isoformat() if self.updated_at else 0)
+
+    def apply_changes(self, changes, session = None, if_unmodified = False):
+        '''
+        Apply {column: value} edits, including the creation_* fields that also maintain join rows. The diff is
+        worked out in memory, then one UPDATE of characters and at most one bulk DELETE and INSERT per join table
+        are issued. Nothing is sent when nothing changed. Caller commits, or rolls back on StaleCharacter.
+        With if_unmodified the UPDATE only matches while updated_at is still the loaded value. Returns the changed columns
+        '''
+        session = session or db.session
+        updates, move_deletes, move_inserts, technique_deletes, technique_inserts = self._diff(changes)
+        if updates:
+            t = Character.__table__
+            values = dict(updates, updated_at = datetime.utcnow())
+            statement = t.update().where(t.c.id == self.id)
+            if if_unmodified:
+                statement = statement.where(t.c.updated_at == self.updated_at if self.updated_at else t.c.updated_at.is_(None))
+            if session.execute(statement.values(**values)).rowcount == 0:
+                raise StaleCharacter(self.id)
+            for attr, value in values.items():
+                set_committed_value(self, attr, value) # keep the instance current without a second flush
+            # picked up at commit to push the changed fields to live subscribers, see live.py
+            session.info.setdefault('changed_characters', {}).setdefault(self, set()).update(updates)
+        if move_deletes:
+            t = CharacterMove.__table__
+            session.execute(t.delete().where(t.c.character_id == self.id, t.c.move_id.in_(move_deletes)))
+        if move_inserts:
+            session.execute(CharacterMove.__table__.insert(), move_inserts)
+        if technique_deletes:
+            t = CharacterTechnique.__table__
+            session.execute(t.delete().where(t.c.character_id == self.id, t.c.technique_id.in_(technique_deletes)))
+        if technique_inserts:
+            session.execute(CharacterTechnique.__table__.insert(), technique_inserts)
+        if move_deletes or move_inserts or technique_deletes or technique_inserts:
+            session.expire(self, ['moves', 'techniques', 'move_rows', 'technique_rows'])
+        return updates
+
     def set(self, attr, value, session = None):
-        if attr == 'creation_stat_increase':
-            self._set_creation_stat(value)
-        elif attr == 'creation_moves':
-            self._set_creation_moves(value, session)
-        elif attr == 'creation_techniques':
-            self._set_creation_techniques(value, session)
-        else:
-            self.__setattr__(attr, value)
+        return self.apply_changes({attr: value}, session)
 
     def get_name(player_id, name):
         return Character.query.filter_by(name = name, player_id = player_id).first()
 
+    @property
+    def catalog_moves(self):
+        ''' Same as moves, but only the join rows are loaded and moves come from the catalog cache '''
+        return [m for m in (Move.get(cm.move_id) for cm in self.move_rows) if m]
+
+    @property
+    def catalog_techniques(self):
+        ''' (technique, mastery) pairs, techniques from the catalog cache '''
+        return [(t, ct.mastery) for t, ct in ((Technique.get(ct.technique_id), ct) for ct in self.technique_rows) if t]
+
+    def sheet(self):
+        ''' Full character sheet: columns plus playbook name, moves and techniques with mastery '''
+        d = self.to_dict()
+        playbook = Playbook.get(self.playbook_id)
+        d['playbook'] = playbook.name if playbook else None
+        d['moves'] = [m.to_dict() for m in self.catalog_moves]
+        d['techniques'] = [dict(t.to_dict(), mastery = mastery) for t, mastery in self.catalog_techniques]
+        return d
+
+    def get_sheets(ids = None, player_id = None):
+        '''
+        Sheets for many characters in three queries whatever the count: characters, then their move and
+        technique rows via selectinload. Catalog rows come from the cache. Results follow the order of ids.
+        '''
+        q = Character.query.options(selectinload(Character.move_rows), selectinload(Character.technique_rows))
+        if ids is not None:
+            q = q.filter(Character.id.in_(ids))
+        if player_id is not None:
+            q = q.filter(Character.player_id == player_id)
+        characters = q.all()
+        if ids is not None:
+            order = {id: i for i, id in enumerate(ids)}
+            characters.sort(key = lambda c: order[c.id])
+        return [c.sheet() for c in characters]
+
+    def make_id(player_id, name):
+        return md5((player_id + name).encode()).hexdigest()
+
+    def create_with_defaults(player_id, characters, session = None, batch_size = 1000):
+        '''
+        Create characters with their playbook's starting stats, the starting moves and the basic techniques.
+        characters is a list of (name, playbook_id) tuples or dicts with name, playbook_id and any other column values;
+        a dict may carry its own player_id to seed characters for many players at once. Rows are bulk inserted in batches inside a single transaction with one commit. Returns the new character ids.
+        '''
+        session = session or db.session
+        moves = Move.starting_moves()
+        techniques = Technique.starting_techniques()
+        now = datetime.utcnow()
+        ids = []
+        character_rows, move_rows, technique_rows = [], [], []
+
+        def flush():
+            session.bulk_insert_mappings(Character, character_rows)
+            session.bulk_insert_mappings(CharacterMove, move_rows)
+            session.bulk_insert_mappings(CharacterTechnique, technique_rows)
+            for rows in (character_rows, move_rows, technique_rows):
+                rows.clear()
+
+        try:
+            for c in characters:
+                row = dict(c) if isinstance(c, dict) else {'name': c[0], 'playbook_id': c[1]}
+                playbook = Playbook.get(row['playbook_id'])
+                if not playbook:
+                    raise ValueError('Unknown playbook: {}'.format(row['playbook_id']))
+                owner_id = row.get('player_id') or player_id
+                character_id = Character.make_id(owner_id, row['name'])
+                for k, v in {'player_id': owner_id, 'id': character_id, 'created_at': now}.items():
+                    row[k] = v
+                for s in statistics:
+                    row.setdefault(s.lower(), playbook.stats[s])
+                character_rows.append(row)
+                move_rows.extend({'character_id': character_id, 'move_id': m.id} for m in moves)
+                technique_rows.extend({'character_id': character_id, 'technique_id': t.id,
+                                       'mastery': 'Basic' if t.technique_type == 'Basic' else 'Learned'} for t in techniques)
+                ids.append(character_id)
+                if len(character_rows) >= batch_size:
+                    flush()
+            flush()
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        logger.debug('Created %d characters for %s', len(ids), player_id)
+        return ids
+
     def __init__(self, player, name, playbook_id, **kwargs):
         super(Character, self).__init__(**kwargs)
         self.player_id = player.id 
         self.name = name
-        self.id = md5((self.player_id + self.name).encode()).hexdigest()
+        self.id = Character.make_id(self.player_id, self.name)
         self.playbook_id = playbook_id
 
 class Player(UserMixin, db.Model, DbMixIn):
@@ -392,7 +832,7 @@ class Player(UserMixin, db.Model, DbMixIn):
     CREATE TABLE players (
         id                              CHAR(32) NOT NULL,
         name                            VARCHAR(255) NOT NULL,
-        password_hash                   CHAR(32) NOT NULL,
+        password_hash                   VARCHAR(255) NOT NULL,
         created_at                      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         updated_at                      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         PRIMARY KEY(id)
@@ -400,27 +840,60 @@ class Player(UserMixin, db.Model, DbMixIn):
     ;
     '''
     __tablename__ = 'players'
+    __table_args__ = (db.Index('ux_players_name', 'name', unique = True),)
     id = db.Column(db.String(32), primary_key = True, nullable = False)
     name = db.Column(db.String(255), nullable = False)
-    password_hash = db.Column(db.String(32), nullable = False)
+    password_hash = db.Column(db.String(255), nullable = False)
     created_at = db.Column(db.DateTime, default = datetime.utcnow)
     updated_at = db.Column(db.DateTime, onupdate = datetime.utcnow)
 
-    characters = db.relationship('Character', back_populates = 'player')
+    characters = db.relationship('Character', back_populates = 'player', lazy = relationship_loading['Player.characters'])
 
     protected_columns_ = ['id','name','created_at']
 
+    def get_identity(id):
+        '''
+        Detached Player for flask-login's user loader, cached in player_cache. Only column attributes
+        are loaded, so query for the player again before touching relationships like characters.
+        '''
+        return player_cache.get_or_load(id, lambda: Player._load_detached(id))
+
+    def _load_detached(id):
+        session = Session(bind = db.engine)
+        try:
+            return session.query(Player).filter_by(id = id).first()
+        finally:
+            session.close()
+
+    def make_id(name):
+        return md5(name.encode()).hexdigest()
+
+    def check_password(self, password):
+        ''' Verify on the hashing pool, upgrading old md5 or lower-cost hashes in place. Caller commits '''
+        ok, new_hash = hasher.verify(password, self.password_hash)
+        if new_hash:
+            self.password_hash = new_hash
+        return ok
+
     def __init__(self, name, password, **kwargs):
         super(Player, self).__init__(**kwargs)
         self.name = name
-        self.id = md5(self.name.encode()).hexdigest()
-        self.password_hash = md5(password.encode()).hexdigest()
+        self.id = Player.make_id(self.name)
+        self.password_hash = hasher.hash(password)
+
+player_cache = LRUTTLCache(maxsize = USER_CACHE_SIZE, ttl = USER_CACHE_TTL)
+
+@event.listens_for(Player, 'after_update')
+@event.listens_for(Player, 'after_delete')
+def _invalidate_player(mapper, connection, target):
+    player_cache.invalidate(target.id)
 
 class CharacterMove(db.Model):
     '''
     CREATE TABLE character_moves (
         character_id                    CHAR(32) NOT NULL,
         move_id                         CHAR(32) NOT NULL,
+        PRIMARY KEY(character_id, move_id),
         FOREIGN KEY(character_id) REFERENCES characters (id) ON DELETE CASCADE,
         FOREIGN KEY(move_id) REFERENCES moves (id) ON DELETE CASCADE
     )
@@ -441,9 +914,10 @@ class CharacterMove(db.Model):
 class CharacterTechnique(db.Model):
     '''
     CREATE TABLE character_techniques (
-        character_id                    CHAR(32),
-        technique_id                    CHAR(32),
+        character_id                    CHAR(32) NOT NULL,
+        technique_id                    CHAR(32) NOT NULL,
         mastery                         ENUM('Basic','Learned','Practiced','Mastered'),
+        PRIMARY KEY(character_id, technique_id),
         FOREIGN KEY(character_id) REFERENCES characters (id) ON DELETE CASCADE,
         FOREIGN KEY(technique_id) REFERENCES techniques (id) ON DELETE CASCADE
     )
@@ -452,7 +926,7 @@ class CharacterTechnique(db.Model):
     __tablename__ = 'character_techniques'
     character_id = db.Column(db.String(32), db.ForeignKey('characters.id'), primary_key = True, nullable = False)
     technique_id = db.Column(db.String(32), db.ForeignKey('techniques.id'), primary_key = True, nullable = False)
-    mastery = db.Column(db.Enum(*['Basic','Learned','Practiced','Mastered']))
+    mastery = db.Column(db.Enum(*masteries))
 
     # character_mastery = db.relationship('Technique', backref = db.backref('technique_mastery'))
 
@@ -468,5 +942,19 @@ class CharacterTechnique(db.Model):
         else:
             self.mastery = mastery
 
-
-
+class CatalogVersion(db.Model):
+    '''
+    CREATE TABLE catalog_version (
+        id                              SMALLINT NOT NULL,
+        version                         INT NOT NULL DEFAULT 0,
+        updated_at                      TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        checksum                        CHAR(64), -- of the content last loaded by catalog_loader
+        PRIMARY KEY(id)
+    )
+    ;
+    '''
+    __tablename__ = 'catalog_version'
+    id = db.Column(db.SmallInteger, primary_key = True, nullable = False)
+    version = db.Column(db.Integer, nullable = False, default = 0)
+    updated_at = db.Column(db.DateTime, default = datetime.utcnow)
+    checksum = db.Column(db.String(64))
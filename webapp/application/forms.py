@@ -6,7 +6,7 @@ from wtforms import Form, validators
 from wtforms.fields import StringField, PasswordField, SelectField, RadioField, TextAreaField, SelectMultipleField, FieldList, FormField
 from wtforms.widgets import ListWidget, CheckboxInput
 
-from .db_model import statistics, trainings, backgrounds, nations
+from .db_model import Playbook, Move, catalog, statistics, trainings, backgrounds, nations
 
 logger = logging.getLogger('forms')
 
@@ -39,13 +39,10 @@ class FieldListLength(object):
         self.message = message
 
     def __call__(self, form, field):
-        logger.debug('Called FieldListLength')
         l = 0
         if field.data:
-            nonnull_data = [x for x in field.data if x]
-            logger.debug(f'nonnull_data {nonnull_data}')
-            l = len(nonnull_data)
-            logger.debug(f'l {l}')
+            l = sum(1 for x in field.data if x)
+        logger.debug('FieldListLength %s has %d entries', field.name, l)
         if l < self.min or self.max != -1 and l > self.max:
             raise validators.ValidationError(self.message)
 
@@ -76,6 +73,25 @@ class MultiCheckboxField(SelectMultipleField):
     widget = ListWidget(prefix_label=False)
     option_widget = CheckboxInput()
 
+def _edit_choices(playbook_id, training):
+    playbook = Playbook.get(playbook_id)
+    base_stats = playbook.str_stats
+    t_lbl = 'Select one learned and one mastered technique'
+    t_lbl_add = '(Select a training to see additional options)'
+    return {
+        'stats': tuple((s, '{} (base: {})'.format(s, base_stats[s])) for s in statistics),
+        'demeanors': tuple(playbook.demeanor_options or ()),
+        'moves': tuple((m.id, m.name + ': ' + m.description) for m in Move.playbook_moves(playbook_id)),
+        'history_questions': tuple(playbook.history_questions or ()),
+        'connections': tuple(c.replace('$BLANK$', '_'*10) for c in playbook.connections or ()),
+        'techniques': tuple((t.id, t.name + ': ' + t.description) for t in catalog.eligible_techniques(playbook_id, training)),
+        'techniques_label': t_lbl if training else ' '.join([t_lbl, t_lbl_add])
+    }
+
+def edit_choices(playbook_id, training):
+    ''' CharacterEditForm choices and labels, built once per (playbook, training) and catalog version '''
+    return catalog.memo(('edit_choices', playbook_id, training), lambda: _edit_choices(playbook_id, training))
+
 # Forms
 class RegistrationForm(Form):
     name = StringField('Player Name', [
@@ -168,21 +184,18 @@ class CharacterEditForm(Form):
     )
 
     def set_choices(self, character):
-        base_stats = character.playbook.str_stats
-        self.creation_stat_increase.choices = [(s, '{} (base: {})'.format(s, base_stats[s])) for s in statistics]
-        self.demeanors.choices = character.playbook.demeanor_options
-        self.creation_moves.choices = [(m.id, m.name + ': ' + m.description) for m in character.playbook.moves]
-        for i, e in enumerate(self.history_questions.entries):
-            e.label = character.playbook.history_questions[i]
-        for i, e in enumerate(self.connections.entries):
-            e.label = character.playbook.connections[i].replace('$BLANK$', '_'*10)
-        t_list = character.available_techniques(include_known = True)
+        choices = edit_choices(character.playbook_id, character.training)
+        self.creation_stat_increase.choices = choices['stats']
+        self.demeanors.choices = choices['demeanors']
+        self.creation_moves.choices = choices['moves']
+        for e, label in zip(self.history_questions.entries, choices['history_questions']):
+            e.label = label
+        for e, label in zip(self.connections.entries, choices['connections']):
+            e.label = label
         for i, e in enumerate(self.creation_techniques.entries):
             e.label = 'Learned' if i == 0 else 'Mastered'
-            e.choices = [(t.id, t.name + ': ' + t.description) for t in t_list]
-        t_lbl = 'Select one learned and one mastered technique'
-        t_lbl_add = '(Select a training to see additional options)'
-        self.creation_techniques.label = t_lbl if character.training else ' '.join([t_lbl, t_lbl_add])
+            e.choices = choices['techniques']
+        self.creation_techniques.label = choices['techniques_label']
 
     def set_defaults(self, character):
         self.creation_stat_increase.data = character.creation_stat_increase
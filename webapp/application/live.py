@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import os
+import logging
+import threading
+from sqlalchemy import event
+
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None
+
+from . import metrics
+from .replicas import RoutingSession
+from .serialize import dumps
+
+logger = logging.getLogger('application')
+
+# streams open at once per process, beyond this clients get 503 and retry. under gevent an idle stream is a cheap
+# greenlet; otherwise it holds one of the worker's WEB_THREADS request threads, so one is always left for other
+# requests. see app_runner.py
+GEVENT = bool(monkey and monkey.is_module_patched('threading'))
+LIVE_MAX_STREAMS = int(os.environ.get('LIVE_MAX_STREAMS', 1000 if GEVENT else int(os.environ.get('WEB_THREADS', 4)) - 1))
+# comment lines sent on idle streams so proxies keep them open and dead clients are noticed
+LIVE_HEARTBEAT_SECONDS = float(os.environ.get('LIVE_HEARTBEAT_SECONDS', 15))
+LIVE_RETRY_MS = int(os.environ.get('LIVE_RETRY_MS', 3000)) # EventSource reconnect delay
+
+published = metrics.Counter('avatar_live_events_total', 'Character deltas published and sent to streams', ['stage'])
+metrics.metrics_.append(published)
+
+class Subscription(object):
+    '''
+    One stream's pending deltas, at most one per character: a delta arriving before the last was sent is merged
+    into it, so a slow client costs memory for its characters' fields, not for every edit
+    '''
+    __slots__ = ('ids', 'pending', 'ready')
+
+    def __init__(self, ids):
+        self.ids = frozenset(ids)
+        self.pending = {} # character id -> (message, encoded body or None once merged)
+        self.ready = threading.Event()
+
+    def put(self, message, body):
+        prev = self.pending.get(message['id'])
+        if prev is not None:
+            message = dict(message, data = dict(prev[0]['data'], **message['data']))
+            body = None
+        self.pending[message['id']] = (message, body)
+        self.ready.set()
+
+class LocalHub(object):
+    '''
+    In-process pub/sub for character deltas. Only streams served by this process hear its publishes, so with
+    several workers run one gevent worker, or swap in a hub whose publish goes through a broker and whose
+    listener hands what it receives to deliver. subscribe, unsubscribe, wait and publish are the whole interface
+    '''
+
+    def __init__(self, max_streams = LIVE_MAX_STREAMS):
+        self.subscribers = {} # character id -> set of Subscription
+        self.streams = 0
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+
+    def subscribe(self, ids):
+        ''' Subscription for the character ids, or None when max_streams are open already '''
+        sub = Subscription(ids)
+        with self._lock:
+            if self.streams >= self.max_streams:
+                return None
+            self.streams += 1
+            for id in sub.ids:
+                self.subscribers.setdefault(id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self.streams -= 1
+            for id in sub.ids:
+                subs = self.subscribers.get(id)
+                subs.discard(sub)
+                if not subs:
+                    del self.subscribers[id]
+
+    def wait(self, sub, timeout):
+        ''' Encoded deltas pending for sub, blocking up to timeout; empty when nothing came '''
+        if not sub.ready.wait(timeout):
+            return []
+        with self._lock:
+            sub.ready.clear()
+            pending, sub.pending = sub.pending, {}
+        published.inc(len(pending), ('sent',))
+        return [body or dumps(message) for message, body in pending.values()]
+
+    def publish(self, messages):
+        self.deliver(messages)
+
+    def deliver(self, messages):
+        for message in messages:
+            published.inc(1, ('published',))
+            if message['id'] not in self.subscribers:
+                continue
+            body = dumps(message) # once, whatever the number of streams
+            with self._lock:
+                for sub in self.subscribers.get(message['id'], ()):
+                    sub.put(message, body)
+
+hub = LocalHub()
+
+def stream(sub, ready):
+    ''' text/event-stream body for sub. ready ({id: etag}) goes first so clients can tell whether to refetch '''
+    try:
+        yield 'retry: {}\n\n'.format(LIVE_RETRY_MS).encode()
+        yield b'event: ready\ndata: ' + dumps(ready) + b'\n\n'
+        while True:
+            bodies = hub.wait(sub, LIVE_HEARTBEAT_SECONDS)
+            if not bodies:
+                yield b': keepalive\n\n'
+            for body in bodies:
+                yield b'event: character\ndata: ' + body + b'\n\n'
+    finally:
+        hub.unsubscribe(sub)
+
+# deltas are built before commit while the changed instances are loaded, and sent only once the commit succeeds
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _before_commit(session):
+    changed = session.info.pop('changed_characters', None)
+    if changed:
+        session.info['live_messages'] = [{'id': c.id, 'etag': c.etag, 'data': c.to_dict(sorted(fields))}
+                                         for c, fields in changed.items()]
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    messages = session.info.pop('live_messages', None)
+    if messages:
+        hub.publish(messages)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('changed_characters', None)
+    session.info.pop('live_messages', None)
+
+@metrics.register_collector
+def live_metrics():
+    yield 'avatar_live_streams', 'gauge', 'Live character streams open in this process', hub.streams
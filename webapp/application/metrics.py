@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import time
+import threading
+from flask import g, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# per-process counters and histograms rendered in Prometheus text format on /metrics.
+# under gunicorn each worker keeps its own, so scrape per worker or sum over instances
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+def _num(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter(object):
+
+    def __init__(self, name, help, labels = ()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount = 1, labels = ()):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} counter'.format(self.name)
+        for labels, v in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name, _labels(self.label_names, labels), _num(v))
+
+class Histogram(object):
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {} # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels = ()):
+        with self._lock:
+            v = self.values.get(labels)
+            if v is None:
+                v = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    v[i] += 1
+                    break
+            v[-2] += value
+            v[-1] += 1
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} histogram'.format(self.name)
+        for labels, v in sorted(self.values.items()):
+            cumulative = 0
+            for b, n in zip(self.buckets, v):
+                cumulative += n
+                yield '{}_bucket{} {}'.format(self.name, _labels(self.label_names + ('le',), labels + (b,)), cumulative)
+            yield '{}_bucket{} {}'.format(self.name, _labels(self.label_names + ('le',), labels + ('+Inf',)), v[-1])
+            yield '{}_sum{} {}'.format(self.name, _labels(self.label_names, labels), _num(v[-2]))
+            yield '{}_count{} {}'.format(self.name, _labels(self.label_names, labels), v[-1])
+
+request_latency = Histogram('avatar_request_duration_seconds', 'Request latency by endpoint', ['endpoint'])
+request_status = Counter('avatar_requests_total', 'Requests by endpoint and status', ['endpoint', 'status'])
+sql_statements = Counter('avatar_sql_statements_total', 'SQL statements executed by endpoint', ['endpoint'])
+sql_seconds = Counter('avatar_sql_duration_seconds_total', 'Time spent executing SQL by endpoint', ['endpoint'])
+pool_wait = Histogram('avatar_db_pool_checkout_wait_seconds', 'Time waiting to check a connection out of the pool',
+                      buckets = POOL_WAIT_BUCKETS)
+
+metrics_ = [request_latency, request_status, sql_statements, sql_seconds, pool_wait]
+collectors_ = [] # callables returning (name, type, help, value) tuples, read at scrape time
+
+def register_collector(fn):
+    collectors_.append(fn)
+    return fn
+
+_sql = threading.local() # per request thread, reset in before_request
+
+def _endpoint():
+    return getattr(_sql, 'endpoint', None) or 'none'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    _sql.count = getattr(_sql, 'count', 0) + 1
+    _sql.seconds = getattr(_sql, 'seconds', 0.0) + elapsed
+
+class TimedQueuePool(QueuePool):
+    ''' QueuePool that records how long each checkout waited for a connection '''
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            pool_wait.observe(time.perf_counter() - start)
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    _sql.endpoint = request.endpoint
+    _sql.count = 0
+    _sql.seconds = 0.0
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        endpoint = _endpoint()
+        request_latency.observe(time.perf_counter() - start, (endpoint,))
+        request_status.inc(labels = (endpoint, response.status_code))
+        if _sql.count:
+            sql_statements.inc(_sql.count, (endpoint,))
+            sql_seconds.inc(_sql.seconds, (endpoint,))
+    _sql.endpoint = None
+    return response
+
+def render():
+    lines = []
+    for m in metrics_:
+        lines.extend(m.render())
+    for fn in collectors_:
+        for name, type, help, value in fn():
+            lines.extend(['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, type), '{} {}'.format(name, _num(value))])
+    return '\n'.join(lines) + '\n'
+
+def metrics_response():
+    return Response(render(), mimetype = 'text/plain; version=0.0.4')
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
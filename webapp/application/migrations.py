@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+'''
+Versioned schema migrations, recorded in schema_migrations. Run from webapp/ with the app's environment:
+
+    python -m application.migrations upgrade    apply pending migrations
+    python -m application.migrations status     list applied and pending versions
+    python -m application.migrations check      EXPLAIN the hot queries, non-zero exit if one cannot use an index
+
+Migrations check the live schema before each step, so they are safe on databases created from
+database/01_avatar_schema.sql, which already has every key below.
+'''
+
+import sys
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, select, text
+
+from . import app, db
+from .db_model import CatalogVersion, Player, Playbook, Move, Technique, Character, CharacterMove, CharacterTechnique
+
+logger = logging.getLogger('application')
+
+schema_migrations = db.Table('schema_migrations',
+    db.Column('version', db.Integer, primary_key = True),
+    db.Column('description', db.String(255)),
+    db.Column('applied_at', db.DateTime)
+)
+
+class Migration(object):
+
+    def __init__(self, version, description, upgrade):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+def _create_indexes(*names):
+    ''' Create model-declared indexes by name unless the table already has them '''
+    def upgrade(conn):
+        insp = inspect(conn)
+        for model in (Player, Playbook, Move, Technique, Character):
+            existing = {i['name'] for i in insp.get_indexes(model.__tablename__)}
+            for index in model.__table__.indexes:
+                if index.name in names and index.name not in existing:
+                    logger.info('Creating index %s', index.name)
+                    index.create(conn)
+    return upgrade
+
+def _catalog_version(conn):
+    CatalogVersion.__table__.create(conn, checkfirst = True)
+    if conn.execute(text('SELECT COUNT(*) FROM catalog_version WHERE id = 1')).scalar() == 0:
+        conn.execute(CatalogVersion.__table__.insert().values(id = 1, version = 0, updated_at = datetime.utcnow()))
+
+def _join_table_keys(conn):
+    '''
+    Primary keys on character_moves and character_techniques, which the ORM assumes but the original schema lacked.
+    Duplicate rows are collapsed first, keeping the highest mastery. MySQL only; SQLite tables come from the models.
+    '''
+    if conn.dialect.name != 'mysql':
+        return
+    insp = inspect(conn)
+    if not insp.get_pk_constraint('character_moves')['constrained_columns']:
+        logger.info('Adding primary key to character_moves')
+        conn.execute(text('CREATE TEMPORARY TABLE cm_dedup AS SELECT DISTINCT character_id, move_id FROM character_moves'))
+        conn.execute(text('DELETE FROM character_moves'))
+        conn.execute(text('INSERT INTO character_moves (character_id, move_id) SELECT character_id, move_id FROM cm_dedup'))
+        conn.execute(text('DROP TEMPORARY TABLE cm_dedup'))
+        conn.execute(text('ALTER TABLE character_moves ADD PRIMARY KEY (character_id, move_id)'))
+    if not insp.get_pk_constraint('character_techniques')['constrained_columns']:
+        logger.info('Adding primary key to character_techniques')
+        conn.execute(text('DELETE FROM character_techniques WHERE character_id IS NULL OR technique_id IS NULL'))
+        # mastery + 0 is the enum's position, so MAX picks the furthest progression
+        conn.execute(text('''CREATE TEMPORARY TABLE ct_dedup AS
+            SELECT character_id, technique_id, ELT(MAX(mastery + 0), 'Basic','Learned','Practiced','Mastered') AS mastery
+            FROM character_techniques GROUP BY character_id, technique_id'''))
+        conn.execute(text('DELETE FROM character_techniques'))
+        conn.execute(text('''INSERT INTO character_techniques (character_id, technique_id, mastery)
+            SELECT character_id, technique_id, mastery FROM ct_dedup'''))
+        conn.execute(text('DROP TEMPORARY TABLE ct_dedup'))
+        conn.execute(text('''ALTER TABLE character_techniques
+            MODIFY character_id CHAR(32) NOT NULL, MODIFY technique_id CHAR(32) NOT NULL,
+            ADD PRIMARY KEY (character_id, technique_id)'''))
+
+def _password_hash_column(conn):
+    if conn.dialect.name == 'mysql': # sqlite does not enforce lengths
+        conn.execute(text('ALTER TABLE players MODIFY password_hash VARCHAR(255) NOT NULL'))
+
+def _character_version_column(conn):
+    # updated_at is the If-Match version, whole seconds would let two edits in the same second share one
+    if conn.dialect.name == 'mysql':
+        conn.execute(text('ALTER TABLE characters MODIFY updated_at TIMESTAMP(6) NULL DEFAULT CURRENT_TIMESTAMP(6)'))
+
+def _catalog_checksum_column(conn):
+    if 'checksum' not in {c['name'] for c in inspect(conn).get_columns('catalog_version')}:
+        conn.execute(text('ALTER TABLE catalog_version ADD COLUMN checksum CHAR(64)'))
+
+MIGRATIONS = [
+    Migration(1, 'catalog_version stamp table', _catalog_version),
+    Migration(2, 'Unique name keys on players, playbooks and characters',
+              _create_indexes('ux_players_name', 'ux_playbooks_name', 'ux_characters_player_name')),
+    Migration(3, 'Catalog lookup and list filter indexes',
+              _create_indexes('ix_moves_move_type', 'ix_moves_playbook_id', 'ix_moves_statistic',
+                              'ix_techniques_type_training', 'ix_techniques_req_training',
+                              'ix_techniques_playbook_id', 'ix_techniques_approach')),
+    Migration(4, 'Primary keys on character join tables', _join_table_keys),
+    Migration(5, 'Widen players.password_hash for salted hashes', _password_hash_column),
+    Migration(6, 'Microsecond characters.updated_at for optimistic concurrency', _character_version_column),
+    Migration(7, 'Content checksum on catalog_version for the catalog loader', _catalog_checksum_column),
+]
+
+def applied_versions(conn):
+    schema_migrations.create(conn, checkfirst = True)
+    return {r[0] for r in conn.execute(schema_migrations.select())}
+
+def upgrade():
+    ''' Apply pending migrations in order, each recorded as soon as it succeeds. Returns the versions applied '''
+    done = []
+    with db.engine.begin() as conn:
+        applied = applied_versions(conn)
+    for m in MIGRATIONS:
+        if m.version in applied:
+            continue
+        logger.info('Applying migration %d: %s', m.version, m.description)
+        with db.engine.begin() as conn: # MySQL commits DDL implicitly, steps check the schema so reruns are safe
+            m.upgrade(conn)
+            conn.execute(schema_migrations.insert().values(version = m.version, description = m.description,
+                                                           applied_at = datetime.utcnow()))
+        done.append(m.version)
+    return done
+
+# hot queries and the index each should use, checked with EXPLAIN
+HOT_QUERIES = [
+    ('Player.get_name', select(Player).where(Player.name == 'x')),
+    ('Character.get_name', select(Character).where(Character.name == 'x', Character.player_id == 'x')),
+    ('characters by player', select(Character).where(Character.player_id == 'x')),
+    ('Move.starting_moves', select(Move).where(Move.move_type.in_(['Basic','Balance','Advancement']))),
+    ('moves by playbook', select(Move).where(Move.playbook_id == 'x')),
+    ('Technique.starting_techniques', select(Technique).where(Technique.technique_type == 'Basic')),
+    ('techniques by training', select(Technique).where(Technique.req_training == 'Firebending')),
+    ('available techniques', select(Technique).where(Technique.technique_type == 'Advanced',
+                                                     Technique.req_training.in_(['Universal', 'Firebending']))),
+    ('character moves', select(CharacterMove).where(CharacterMove.character_id == 'x')),
+    ('character techniques', select(CharacterTechnique).where(CharacterTechnique.character_id == 'x')),
+]
+
+def explain(conn, statement):
+    ''' (uses index, plan summary) for a select statement '''
+    sql = str(statement.compile(dialect = conn.dialect, compile_kwargs = {'literal_binds': True}))
+    if conn.dialect.name == 'sqlite':
+        details = [r[-1] for r in conn.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+        uses_index = all('INDEX' in d or 'PRIMARY KEY' in d for d in details if d.startswith(('SCAN', 'SEARCH')))
+        return uses_index, '; '.join(details)
+    rows = [dict(r._mapping) for r in conn.execute(text('EXPLAIN ' + sql))]
+    # tiny tables may still be scanned by choice, an index being usable is what matters here
+    uses_index = all(r.get('key') or r.get('possible_keys') for r in rows)
+    return uses_index, '; '.join('{} type={} key={} possible={}'.format(r.get('table'), r.get('type'), r.get('key'),
+                                 r.get('possible_keys')) for r in rows)
+
+def plans():
+    ''' (name, uses index, plan summary) for each hot query '''
+    with db.engine.connect() as conn:
+        return [(name,) + explain(conn, query) for name, query in HOT_QUERIES]
+
+def check():
+    ''' Print the hot query plans, returns how many cannot use an index '''
+    failures = 0
+    for name, ok, plan in plans():
+        failures += not ok
+        print('{:<5} {:<32} {}'.format('ok' if ok else 'SCAN', name, plan))
+    return failures
+
+def main(argv):
+    command = argv[0] if argv else 'status'
+    with app.app_context():
+        if command == 'upgrade':
+            done = upgrade()
+            print('Applied {}'.format(done) if done else 'Up to date')
+        elif command == 'status':
+            with db.engine.begin() as conn:
+                applied = applied_versions(conn)
+            for m in MIGRATIONS:
+                print('{} {:>3} {}'.format('applied' if m.version in applied else 'pending', m.version, m.description))
+        elif command == 'check':
+            return 1 if check() else 0
+        else:
+            print(__doc__)
+            return 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+from sqlalchemy import select
+
+from . import db
+from .db_model import Move, Character, CharacterMove, catalog, statistics
+
+# a move roll is 2d6 + the move's stat + modifiers: 6 or less misses, 7-9 is a weak hit, 10 or more a strong hit.
+# the total modifier never goes past +4 or below -3
+WEAK_HIT = 7
+STRONG_HIT = 10
+MIN_BONUS = -3
+MAX_BONUS = 4
+OUTCOMES = ['miss', 'weak_hit', 'strong_hit']
+# monte carlo rolls per request, the default and the most a client may ask for
+ODDS_SAMPLES = int(os.environ.get('ODDS_SAMPLES', 100000))
+ODDS_MAX_SAMPLES = int(os.environ.get('ODDS_MAX_SAMPLES', 1000000))
+# numpy takes non-negative seeds, one 64 bit word is plenty
+MAX_SEED = 2 ** 64 - 1
+# with stats in the bonus range, a wider modifier clips to the same odds
+MAX_MODIFIER = MAX_BONUS - MIN_BONUS
+
+_FACES = np.arange(1, 7)
+_TOTALS = np.add.outer(_FACES, _FACES).ravel() # the 36 equally likely 2d6 totals
+_STAT_INDEX = {s: i for i, s in enumerate(statistics)}
+STAT_COLUMNS = [s.lower() for s in statistics] # Character columns in statistics order
+
+def exact_pmf():
+    ''' Probability of each 2d6 total, indexed by the total (0 and 1 are impossible) '''
+    return np.bincount(_TOTALS, minlength = 13) / _TOTALS.size
+
+def simulated_pmf(samples, seed = None):
+    '''
+    Frequency of each 2d6 total over samples simulated rolls. The counts of rolls landing on each total are drawn
+    from their multinomial, which is distributed exactly like rolling them one by one, in time independent of samples
+    '''
+    return np.random.default_rng(seed).multinomial(samples, exact_pmf()) / samples
+
+def outcome_table(pmf):
+    '''
+    (bonus, outcome) probabilities for every bonus from MIN_BONUS to MAX_BONUS. Any number of rolls is resolved
+    by indexing this with their bonuses, so the dice are only ever worked out once per request
+    '''
+    cdf = np.concatenate([[0.0], np.cumsum(pmf)]) # cdf[t] = P(total < t)
+    bonuses = np.arange(MIN_BONUS, MAX_BONUS + 1)
+    miss = cdf[np.clip(WEAK_HIT - bonuses, 0, len(pmf))]
+    below_strong = cdf[np.clip(STRONG_HIT - bonuses, 0, len(pmf))]
+    return np.clip(np.stack([miss, below_strong - miss, 1 - below_strong], axis = 1), 0, 1) # no -0.0 from rounding
+
+def resolve(stats, character_index, stat_index, modifiers, table):
+    '''
+    Outcome probabilities for many rolls at once. stats is (characters, 4) in statistics order, each roll i is
+    character character_index[i] rolling stat stat_index[i] (-1 for moves without one) plus modifiers of its
+    character. Returns (bonuses, probabilities), rows of moves without a stat are NaN
+    '''
+    bonus = stats[character_index, np.maximum(stat_index, 0)] + modifiers[character_index]
+    bonus = np.clip(bonus, MIN_BONUS, MAX_BONUS)
+    probabilities = table[bonus - MIN_BONUS]
+    probabilities[stat_index < 0] = np.nan
+    return bonus, probabilities
+
+def _move_table():
+    ''' move id -> (stat index or -1, result row with blank odds), built once per catalog version '''
+    return {m.id: (_STAT_INDEX.get(m.statistic, -1), dict({'move_id': m.id, 'name': m.name, 'statistic': m.statistic,
+                                                           'bonus': None}, **dict.fromkeys(OUTCOMES)))
+            for m in catalog.snapshot().all[Move]}
+
+def load_party(ids = None, player_id = None):
+    '''
+    (characters, move ids by character id) for character_odds in two plain selects, only the columns the odds
+    need. Characters follow the order of ids
+    '''
+    c, cm = Character.__table__, CharacterMove.__table__
+    q = select(c.c.id, c.c.name, *[c.c[s] for s in STAT_COLUMNS])
+    if ids is not None:
+        q = q.where(c.c.id.in_(ids))
+    if player_id is not None:
+        q = q.where(c.c.player_id == player_id)
+    characters = db.session.execute(q).all()
+    if ids is not None:
+        order = {id: i for i, id in enumerate(ids)}
+        characters.sort(key = lambda r: order[r.id])
+    move_ids = {r.id: [] for r in characters}
+    if move_ids:
+        for character_id, move_id in db.session.execute(select(cm.c.character_id, cm.c.move_id).where(cm.c.character_id.in_(list(move_ids)))):
+            move_ids[character_id].append(move_id)
+    return characters, move_ids
+
+def character_odds(characters, move_ids, modifier = 0, samples = None, seed = None):
+    '''
+    Odds of every move of every character, resolved in one vectorized pass. Exact unless samples is given, then
+    from that many simulated rolls shared by all characters. Takes what load_party returns
+    '''
+    table = outcome_table(exact_pmf() if samples is None else simulated_pmf(samples, seed))
+    move_table = catalog.memo('odds_moves', _move_table)
+    moves = [[move_table[m] for m in move_ids[c.id] if m in move_table] for c in characters]
+    stats = np.array([[getattr(c, s) or 0 for s in STAT_COLUMNS] for c in characters], dtype = np.int64).reshape(-1, 4)
+    character_index = np.repeat(np.arange(len(characters)), [len(m) for m in moves])
+    stat_index = np.array([i for ms in moves for i, _ in ms], dtype = np.int64)
+    modifiers = np.full(len(characters), modifier, dtype = np.int64)
+    bonus, probabilities = resolve(stats, character_index, stat_index, modifiers, table)
+    bonus, probabilities = bonus.tolist(), np.round(probabilities, 4).tolist()
+
+    results, i = [], 0
+    for c, ms in zip(characters, moves):
+        rows = []
+        for stat, blank in ms:
+            row = dict(blank)
+            if stat >= 0:
+                row['bonus'] = bonus[i]
+                row.update(zip(OUTCOMES, probabilities[i]))
+            rows.append(row)
+            i += 1
+        results.append({'character_id': c.id, 'name': c.name, 'moves': rows})
+    return results
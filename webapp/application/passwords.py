@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import os
+import hmac
+import time
+import base64
+import hashlib
+import logging
+import threading
+from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+except ImportError:
+    monkey = None
+
+from . import metrics
+
+logger = logging.getLogger('application')
+
+# pbkdf2 cost, raise over time. hashes made with fewer iterations are upgraded on the next login
+PASSWORD_ITERATIONS = int(os.environ.get('PASSWORD_ITERATIONS', 260000))
+# hashlib releases the GIL while hashing, so a thread pool spreads the cost across cores. under gevent workers the
+# pool uses gevent's native threads, patched threads are greenlets and a hash would stall every other request
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+# hashes running or waiting beyond this are refused, and the route answers 503
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', 4 * PASSWORD_HASH_WORKERS))
+# a request gives up (503) after waiting this long, its hash keeps its queue slot until it finishes
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+SCHEME = 'pbkdf2_sha256'
+
+hash_seconds = metrics.Histogram('avatar_password_hash_seconds', 'Time spent hashing a password in the worker pool',
+                                 buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+hash_rejected = metrics.Counter('avatar_password_hash_rejected_total', 'Hash requests refused, queue full or wait timed out',
+                                ['reason'])
+metrics.metrics_.extend([hash_seconds, hash_rejected])
+
+class HashingOverloaded(Exception):
+    ''' The hashing queue is full, retry later '''
+
+def _b64(b):
+    return base64.b64encode(b).decode().rstrip('=')
+
+def _pbkdf2(password, salt, iterations):
+    ''' (hash, seconds), timed here and recorded by the caller, off the native thread under gevent '''
+    start = time.perf_counter()
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+    return _b64(digest), time.perf_counter() - start
+
+class PasswordHasher(object):
+    '''
+    Salted pbkdf2 hashing on a bounded thread pool. Hashes are stored as pbkdf2_sha256$iterations$salt$hash;
+    legacy unsalted md5 hex digests still verify and are flagged for rehash.
+    '''
+
+    def __init__(self, iterations = PASSWORD_ITERATIONS, workers = PASSWORD_HASH_WORKERS,
+                 queue_limit = PASSWORD_HASH_QUEUE_LIMIT, timeout = PASSWORD_HASH_TIMEOUT):
+        self.iterations = iterations
+        self.timeout = timeout
+        self.queue_limit = queue_limit
+        if monkey and monkey.is_module_patched('threading'):
+            self._executor = NativeThreadPoolExecutor(max_workers = workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'password-hash')
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._lock = threading.Lock()
+        self.depth = 0 # running + waiting
+
+    def _track(self, n):
+        with self._lock:
+            self.depth += n
+
+    def _release(self, future):
+        self._track(-1)
+        self._slots.release()
+        if future is not None and not future.cancelled() and future.exception() is None:
+            hash_seconds.observe(future.result()[1])
+
+    def _run(self, password, salt, iterations):
+        if not self._slots.acquire(blocking = False):
+            hash_rejected.inc(1, ('queue_full',))
+            raise HashingOverloaded()
+        self._track(1)
+        try:
+            future = self._executor.submit(_pbkdf2, password, salt, iterations)
+        except BaseException:
+            self._release(None)
+            raise
+        # the slot is freed when the hash is done, not when the caller stops waiting, so queue_limit holds
+        future.add_done_callback(self._release)
+        try:
+            return future.result(self.timeout)[0]
+        except FutureTimeout:
+            future.cancel() # frees the slot now if the hash has not started
+            hash_rejected.inc(1, ('timeout',))
+            raise HashingOverloaded()
+
+    def hash(self, password):
+        salt = _b64(os.urandom(16))
+        return '{}${}${}${}'.format(SCHEME, self.iterations, salt, self._run(password, salt, self.iterations))
+
+    def needs_rehash(self, stored):
+        parts = stored.split('$')
+        return len(parts) != 4 or parts[0] != SCHEME or int(parts[1]) != self.iterations
+
+    def verify(self, password, stored):
+        ''' (matches, new hash to store or None) '''
+        parts = stored.split('$')
+        if len(parts) == 4 and parts[0] == SCHEME:
+            ok = hmac.compare_digest(self._run(password, parts[2], int(parts[1])), parts[3])
+        else: # legacy md5 hex digest
+            ok = hmac.compare_digest(md5(password.encode()).hexdigest(), stored)
+        if ok and self.needs_rehash(stored):
+            return True, self.hash(password)
+        return ok, None
+
+hasher = PasswordHasher()
+
+@metrics.register_collector
+def hash_queue_metrics():
+    yield 'avatar_password_hash_queue_depth', 'gauge', 'Password hashes running or waiting', hasher.depth
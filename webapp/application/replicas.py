@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import os
+import time
+import logging
+import threading
+from itertools import count
+from flask import current_app, g, request, has_request_context, session as client_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from . import metrics
+
+logger = logging.getLogger('application')
+
+# read replicas, comma separated URIs. GET requests read from one of them, everything else uses the primary
+DATABASE_REPLICA_URIS = [u for u in os.environ.get('DATABASE_REPLICA_URIS', '').split(',') if u]
+# after a client commits a write its reads stay on the primary this long, so it sees its own edits despite lag
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# a replica that failed is skipped this long before it is tried again
+REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+
+STICKY_KEY = 'db_primary_until'
+
+class ReplicaRouter(object):
+    '''
+    Picks the engine for each request. GET and HEAD requests go round robin over healthy replicas unless the
+    client wrote recently; writes, flushes and everything outside a request use the primary. A replica that
+    raises OperationalError is marked down and the request is run again on the primary.
+    '''
+
+    def __init__(self):
+        self.keys = []
+        self.down_until = {}
+        self.engines = {} # id(engine) -> bind key, filled as replica engines are created
+        self._next = count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, uris = DATABASE_REPLICA_URIS):
+        if not uris:
+            return
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {}) or {}
+        for i, uri in enumerate(uris):
+            key = 'replica_{}'.format(i)
+            binds[key] = uri
+            self.keys.append(key)
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.before_request(self._before_request)
+        app.register_error_handler(OperationalError, self._replica_failed)
+        logger.info('Reading from %d replicas: %s', len(uris), ', '.join(u.split('@')[-1] for u in uris))
+
+    def healthy(self):
+        now = time.monotonic()
+        return [k for k in self.keys if self.down_until.get(k, 0) <= now]
+
+    def pick(self):
+        healthy = self.healthy()
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+    def mark_down(self, key, error):
+        with self._lock:
+            self.down_until[key] = time.monotonic() + REPLICA_RETRY_SECONDS
+        logger.warning('Replica %s unavailable, using the primary for %ss: %s', key, REPLICA_RETRY_SECONDS, error)
+
+    def engine(self, db, key):
+        engine = db.get_engine(db.get_app(), bind = key)
+        self.engines[id(engine)] = key
+        return engine
+
+    def _before_request(self):
+        g.db_replica = None
+        if request.method not in ('GET', 'HEAD') or client_session.get(STICKY_KEY, 0) > time.time():
+            return
+        g.db_replica = self.pick()
+
+    def _replica_failed(self, e):
+        # handle_error below has marked the replica down if it was the one failing, GET views are safe to rerun
+        key = g.get('db_replica')
+        if not key or key in self.healthy():
+            raise e
+        current_app.extensions['sqlalchemy'].db.session.rollback()
+        g.db_replica = None
+        logger.info('Retrying %s on the primary', request.endpoint)
+        return current_app.view_functions[request.endpoint](**request.view_args)
+
+    def replica_for(self, session, clause):
+        ''' Bind key to read from for this statement, or None for the primary '''
+        if not has_request_context():
+            return None
+        if getattr(clause, 'is_dml', False): # core writes skip the flush, note them for stickiness too
+            session.info['wrote'] = True
+            return None
+        key = g.get('db_replica')
+        if key is None or session._flushing or session.info.get('wrote'):
+            return None
+        return key
+
+router = ReplicaRouter()
+
+class RoutingSession(SignallingSession):
+    ''' SignallingSession that sends reads to the replica chosen for the request '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper = None, clause = None):
+        key = router.replica_for(self, clause)
+        if key is not None:
+            return router.engine(self.db, key)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_ = RoutingSession, db = self, **options)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info['wrote'] = True
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('wrote', False) and router.keys and has_request_context():
+        client_session[STICKY_KEY] = time.time() + REPLICA_STICKY_SECONDS
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('wrote', None)
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    key = router.engines.get(id(context.engine))
+    if key and isinstance(context.sqlalchemy_exception, OperationalError):
+        router.mark_down(key, context.original_exception)
+
+@metrics.register_collector
+def replica_metrics():
+    if router.keys:
+        yield 'avatar_db_replicas_healthy', 'gauge', 'Read replicas currently in rotation', len(router.healthy())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''
+NDJSON roster export and import, one character per line with its moves and techniques:
+
+    {"id": ..., "name": ..., ..., "moves": ["<move id>", ...], "techniques": {"<technique id>": "Learned", ...}}
+
+Served on /api/characters/export and /api/characters/import for the logged in player, and for whole
+databases by roster_cli.py.
+
+Export reads characters through a server-side cursor in partitions, so memory stays flat however big the roster.
+Import validates playbook, move and technique ids against the catalog, skips characters that already exist,
+and inserts each batch with executemany in its own transaction, reporting per-batch throughput.
+'''
+
+import time
+import json
+import logging
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .db_model import Player, Move, Technique, Character, CharacterMove, CharacterTechnique, masteries
+from .serialize import serializer_for, dumps, TIMESTAMP_FORMAT
+
+logger = logging.getLogger('application')
+
+EXPORT_BATCH_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+
+def export_characters(player_id = None, batch_size = EXPORT_BATCH_SIZE):
+    '''
+    Yields one NDJSON line (bytes, newline included) per character, ordered by id. Characters stream from a
+    server-side cursor; join rows are read per partition on a second connection, since MySQL cannot run another
+    query on a connection while an unbuffered result is open
+    '''
+    characters = Character.__table__
+    moves, techniques = CharacterMove.__table__, CharacterTechnique.__table__
+    to_dict = serializer_for(Character).to_dict
+    query = select(characters).order_by(characters.c.id)
+    if player_id:
+        query = query.where(characters.c.player_id == player_id)
+    with db.engine.connect() as stream, db.engine.connect() as lookup:
+        result = stream.execution_options(stream_results = True).execute(query)
+        for rows in result.partitions(batch_size):
+            ids = [r.id for r in rows]
+            character_moves = {i: [] for i in ids}
+            for r in lookup.execute(select(moves.c.character_id, moves.c.move_id).where(moves.c.character_id.in_(ids))):
+                character_moves[r.character_id].append(r.move_id)
+            character_techniques = {i: {} for i in ids}
+            for r in lookup.execute(select(techniques).where(techniques.c.character_id.in_(ids))):
+                character_techniques[r.character_id][r.technique_id] = r.mastery
+            for r in rows:
+                d = to_dict(r)
+                d['moves'] = character_moves[r.id]
+                d['techniques'] = character_techniques[r.id]
+                yield dumps(d) + b'\n'
+
+_character_columns = [c.key for c in Character.__table__.columns]
+_timestamp_columns = [c.key for c in Character.__table__.columns if isinstance(c.type, db.DateTime)]
+
+def _parse(line, player_id):
+    ''' (character row, move rows, technique rows) from one export line, raises ValueError '''
+    d = json.loads(line)
+    if not isinstance(d, dict) or not d.get('name'):
+        raise ValueError('not a character object')
+    moves, techniques = d.get('moves', []), d.get('techniques', {})
+    if not isinstance(moves, list) or not all(isinstance(m, str) for m in moves):
+        raise ValueError('moves must be a list of move ids')
+    if len(set(moves)) != len(moves):
+        raise ValueError('moves lists a move more than once')
+    if not isinstance(techniques, dict) or not all(isinstance(m, str) for m in techniques.values()):
+        raise ValueError('techniques must map technique ids to masteries')
+    unknown = [m for m in moves if not Move.get(m)]
+    unknown += [t for t in techniques if not Technique.get(t)]
+    if unknown:
+        raise ValueError('unknown moves/techniques {}'.format(', '.join(unknown)))
+    bad = [m for m in techniques.values() if m not in masteries]
+    if bad:
+        raise ValueError('unknown mastery {}'.format(', '.join(bad)))
+    row = {k: d[k] for k in _character_columns if k in d}
+    # the same checks a PATCH gets, nulls are left to the insert since exports carry them for unset fields
+    problems = Character.check_changes({k: v for k, v in row.items() if v is not None and k not in _timestamp_columns})
+    if problems:
+        raise ValueError('; '.join('{} {}'.format(k, p) for k, p in sorted(problems.items())))
+    if player_id: # reassigning, ids derive from the owner
+        row['player_id'] = player_id
+        row['id'] = Character.make_id(player_id, row['name'])
+    if not row.get('player_id') or not row.get('id'):
+        raise ValueError('missing player_id or id')
+    for k in _timestamp_columns:
+        if row.get(k):
+            if not isinstance(row[k], str):
+                raise ValueError('{} must be a timestamp'.format(k))
+            row[k] = datetime.strptime(row[k], TIMESTAMP_FORMAT)
+    move_rows = [{'character_id': row['id'], 'move_id': m} for m in moves]
+    technique_rows = [{'character_id': row['id'], 'technique_id': t, 'mastery': m} for t, m in techniques.items()]
+    return row, move_rows, technique_rows
+
+def _insert_batch(batch):
+    ''' Insert parsed (line number, row, moves, techniques) entries. Returns (inserted, skipped, errors) '''
+    characters = Character.__table__
+    errors = []
+    with db.engine.begin() as conn:
+        player_ids = {r['player_id'] for _, r, _, _ in batch}
+        players = set(conn.execute(select(Player.__table__.c.id).where(Player.__table__.c.id.in_(player_ids))).scalars())
+        existing = conn.execute(select(characters.c.id, characters.c.player_id, characters.c.name).where(
+            characters.c.id.in_([r['id'] for _, r, _, _ in batch]) |
+            tuple_(characters.c.player_id, characters.c.name).in_([(r['player_id'], r['name']) for _, r, _, _ in batch])
+        )).all()
+        existing_ids = {e.id for e in existing}
+        taken_names = {(e.player_id, e.name) for e in existing}
+        rows, move_rows, technique_rows = [], [], []
+        skipped = 0
+        for n, row, moves, techniques in batch:
+            if row['id'] in existing_ids:
+                skipped += 1
+            elif row['player_id'] not in players:
+                errors.append((n, 'unknown player {}'.format(row['player_id'])))
+            elif (row['player_id'], row['name']) in taken_names:
+                errors.append((n, 'player already has a character named {}'.format(row['name'])))
+            else:
+                existing_ids.add(row['id'])
+                taken_names.add((row['player_id'], row['name']))
+                rows.append(row)
+                move_rows.extend(moves)
+                technique_rows.extend(techniques)
+        # executemany binds the same columns for every row, so rows go in grouped by the keys they carry and
+        # columns a line leaves out keep their defaults
+        groups = {}
+        for r in rows:
+            groups.setdefault(frozenset(r), []).append(r)
+        for group in groups.values():
+            conn.execute(characters.insert(), group)
+        if move_rows:
+            conn.execute(CharacterMove.__table__.insert(), move_rows)
+        if technique_rows:
+            conn.execute(CharacterTechnique.__table__.insert(), technique_rows)
+    return len(rows), skipped, errors
+
+def import_characters(lines, player_id = None, batch_size = IMPORT_BATCH_SIZE, report = None):
+    '''
+    Load export lines. player_id, when given, takes ownership of every character. Invalid lines are reported
+    and skipped, existing characters are left alone. report(batch number, stats) is called after each batch.
+    Returns totals with the per-line errors
+    '''
+    totals = {'inserted': 0, 'skipped': 0, 'errors': [], 'seconds': 0.0}
+    batch = []
+    n_batch = 0
+
+    def flush():
+        start = time.perf_counter()
+        try:
+            inserted, skipped, errors = _insert_batch(batch)
+        except IntegrityError as e: # a conflict the checks missed, such as a concurrent import; nothing was written
+            logger.warning('Import batch %d rejected: %s', n_batch, e.orig)
+            inserted, skipped = 0, 0
+            errors = [(n, 'batch rejected by the database: {}'.format(e.orig)) for n, _, _, _ in batch]
+        seconds = time.perf_counter() - start
+        totals['inserted'] += inserted
+        totals['skipped'] += skipped
+        totals['errors'].extend(errors)
+        totals['seconds'] += seconds
+        if report:
+            report(n_batch, {'rows': len(batch), 'inserted': inserted, 'skipped': skipped, 'errors': len(errors),
+                             'seconds': round(seconds, 3), 'rows_per_second': round(len(batch) / seconds) if seconds else None})
+        batch.clear()
+
+    for n, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            batch.append((n,) + _parse(line, player_id))
+        except ValueError as e: # json errors are ValueErrors too
+            totals['errors'].append((n, str(e)))
+        if len(batch) >= batch_size:
+            n_batch += 1
+            flush()
+    if batch:
+        n_batch += 1
+        flush()
+    logger.info('Imported %d characters, skipped %d existing, %d errors', totals['inserted'], totals['skipped'], len(totals['errors']))
+    return totals
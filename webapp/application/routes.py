@@ -4,25 +4,53 @@ import os
 import json
 import logging
 from datetime import datetime
-from hashlib import md5
-from flask import request, render_template, url_for, flash, redirect, abort
+from flask import request, render_template, url_for, flash, redirect, abort, Response, stream_with_context
 from flask_login import current_user, login_user, logout_user, login_required
+from sqlalchemy.orm import selectinload, load_only
 from is_safe_url import is_safe_url
 
-from . import app, db, login_manager
+from . import app, db, login_manager, metrics, live, odds
+from .passwords import HashingOverloaded
 from .db_model import *
+from .serialize import serialize, success_body, failure_body, json_response, prepared_response
+from .roster import export_characters, import_characters
 from .forms import RegistrationForm, LoginForm, CharacterCreateForm, CharacterEditForm, flash_errors
 
 FLASK_APP_HOST = os.environ['FLASK_APP_HOST']
 
 logger = logging.getLogger('routes')
 
+# eager loading per route so each page loads its object graph in a fixed number of queries
+HOME_LOADING = [selectinload(Player.characters).joinedload(Character.playbook)]
+
 # configure login 
 @login_manager.user_loader
 def load_user(id):
-    return Player.get(id)
+    return Player.get_identity(id)
 login_manager.login_view = 'login'
 
+@metrics.register_collector
+def cache_and_pool_metrics():
+    stats = player_cache.stats()
+    snap = catalog._snapshot
+    yield 'avatar_user_cache_hits_total', 'counter', 'flask-login identity cache hits', stats['hits']
+    yield 'avatar_user_cache_misses_total', 'counter', 'flask-login identity cache misses', stats['misses']
+    yield 'avatar_user_cache_size', 'gauge', 'Cached player identities', stats['size']
+    yield 'avatar_catalog_version', 'gauge', 'Loaded catalog version', (snap.version or 0) if snap else -1
+    pool = db.engine.pool
+    if hasattr(pool, 'checkedout'):
+        yield 'avatar_db_pool_checked_out', 'gauge', 'Connections currently checked out', pool.checkedout()
+        yield 'avatar_db_pool_overflow', 'gauge', 'Connections open beyond pool_size', max(pool.overflow(), 0)
+
+@app.route('/metrics')
+def get_metrics():
+    return metrics.metrics_response()
+
+@app.errorhandler(HashingOverloaded)
+def hashing_overloaded(e):
+    logger.warning('Password hashing queue full, shedding %s', request.endpoint)
+    return 'Too many logins right now, please try again in a moment', 503, {'Retry-After': '2'}
+
 @app.route('/')
 def index():
     logger.debug('Request to index')
@@ -32,7 +60,8 @@ def index():
 @login_required
 def home():
     logger.debug('Request to home')
-    return render_template('home.html', player = current_user)
+    player = Player.get(current_user.id, options = HOME_LOADING)
+    return render_template('home.html', player = player)
 
 @app.route('/register', methods = ['GET','POST'])
 def register():
@@ -40,14 +69,14 @@ def register():
     form = RegistrationForm(request.form)
     if request.method == 'POST' and form.validate():
         player_name = form.name.data 
-        logger.debug(f'Call to create_player for {player_name}')
+        logger.debug('Call to create_player for %s', player_name)
         if Player.get_name(player_name):
             flash('''Player name {name} already exists. <a href="{url}">Login here.</a>'''.format(name = player_name, url = url_for('login')), 'danger')
         else:
             player = Player(player_name, form.password.data)
             db.session.add(player)
             db.session.commit()
-            logger.debug(f'Inserted {player.id}')
+            logger.debug('Inserted %s', player.id)
             login_user(player)
             return redirect(url_for('home'))
     else:
@@ -60,17 +89,17 @@ def login():
     form = LoginForm(request.form)
     if request.method == 'POST' and form.validate():
         player_name = form.name.data 
-        logger.debug('Login for {player_name} submitted')
-        req_pw = md5(form.password.data.encode()).hexdigest()
+        logger.debug('Login for %s submitted', player_name)
         player = Player.get_name(player_name)
         if not player:
             flash('''No player with that name exists. <a href="{url}">Sign up here!</a>'''.format(url = url_for('register')), 'danger')
         else:
-            if req_pw != player.password_hash:
+            if not player.check_password(form.password.data):
                 flash('Incorrect player name or password', 'danger')
                 logger.debug('Failed attempt')
             else:
                 logger.debug('Successful attempt')
+                db.session.commit() # stores the upgraded hash if check_password rehashed
                 login_user(player)
                 # handle if user was redirected to login
                 next = request.args.get('next')
@@ -107,20 +136,9 @@ def create_character():
             flash('You already have a character with that name', 'danger')
         else:
             playbook_id = form.playbook_id.data
-            character = Character(player, character_name, playbook_id)
-            db.session.add(character)
-            for move in Move.starting_moves():
-                cm = CharacterMove(character.id, move.id)
-                db.session.add(cm)
-            for technique in Technique.starting_techniques():
-                ct = CharacterTechnique(character.id, technique.id)
-                db.session.add(ct)
-            db.session.commit()
-            for s in statistics:
-                character.set(s.lower(), character.playbook.stats[s])
-            db.session.commit()
-            logger.debug(f'{character.name} created')
-            return redirect(url_for('edit_character', character_id = character.id))
+            character_id = Character.create_with_defaults(player.id, [(character_name, playbook_id)])[0]
+            logger.debug('%s created', character_name)
+            return redirect(url_for('edit_character', character_id = character_id))
     else:
         flash_errors(form)
     return render_template('character_create.html', form = form)
@@ -130,19 +148,14 @@ def create_character():
 def edit_character(character_id):
     ''' ZZ docstring '''
     logger.debug('Call to edit_character')
-    character = Character.get(character_id)
+    character = Character.get(character_id) # form choices come from the catalog, the playbook is not needed
     form = CharacterEditForm(request.form)
     form.set_choices(character)
     if request.method == 'POST' and form.validate():
-        for field, value in form.data.items():
-            if value and any(value):
-                # all this junk should probably be methods of Character
-                if field in ['creation_moves','creation_techniques']:
-                    character.set(field, value, session = db.session)
-                else:
-                    character.set(field, value)
+        changes = {field: value for field, value in form.data.items() if value and any(value)}
+        updated = character.apply_changes(changes)
         db.session.commit()
-        logger.debug(f'Updated {character.id}')
+        logger.debug('Updated %s: %s', character.id, sorted(updated))
         form.set_choices(character) # repopulate choices based on submitted data
         flash('Character updated', 'success') 
         # return redirect(url_for('home')) # can eventually go to character sheet
@@ -154,91 +167,270 @@ def edit_character(character_id):
 @app.route('/api/character/<character_id>', methods = ['GET'])
 def get_character(character_id):
     ''' docstring '''
-    logger.debug(f'Call to get_character for {character_id}')
-    data = Character.get(character_id).to_dict()
-    resp = {'status': 'success', 'data': data}
-    logger.debug(f'Returned {data}')
-    return json.dumps(resp)
+    logger.debug('Call to get_character for %s', character_id)
+    character = Character.get_or_404(character_id)
+    return json_response(success_body(character.to_dict()), headers = {'ETag': character.etag})
+
+MAX_SHEETS = 100
+
+@app.route('/api/characters', methods = ['GET'])
+def get_characters():
+    ''' Full sheets for ids=a,b,c or for every character of player_id, e.g. for a GM screen '''
+    logger.debug('Call to get_characters')
+    ids = request.args.get('ids')
+    player_id = request.args.get('player_id')
+    if not ids and not player_id:
+        return json_response(failure_body('Pass ids or player_id'), status = 400)
+    ids = list(dict.fromkeys(ids.split(','))) if ids else None
+    if ids and len(ids) > MAX_SHEETS:
+        return json_response(failure_body('At most {} ids per request'.format(MAX_SHEETS)), status = 400)
+    data = Character.get_sheets(ids = ids, player_id = player_id)
+    return json_response(success_body(data))
+
+def _odds_options():
+    ''' modifier, samples and seed from the query string, raises ValueError. samples is None for exact odds '''
+    method = request.args.get('method', 'exact')
+    if method not in ('exact', 'monte_carlo'):
+        raise ValueError('method must be exact or monte_carlo')
+    try:
+        modifier = int(request.args.get('modifier', 0))
+        samples = int(request.args.get('samples', odds.ODDS_SAMPLES)) if method == 'monte_carlo' else None
+        seed = int(request.args['seed']) if 'seed' in request.args else None
+    except ValueError:
+        raise ValueError('modifier, samples and seed must be whole numbers')
+    if samples is not None and not 0 < samples <= odds.ODDS_MAX_SAMPLES:
+        raise ValueError('samples must be between 1 and {}'.format(odds.ODDS_MAX_SAMPLES))
+    if not -odds.MAX_MODIFIER <= modifier <= odds.MAX_MODIFIER:
+        raise ValueError('modifier must be between {} and {}'.format(-odds.MAX_MODIFIER, odds.MAX_MODIFIER))
+    if seed is not None and not 0 <= seed <= odds.MAX_SEED:
+        raise ValueError('seed must be between 0 and {}'.format(odds.MAX_SEED))
+    return {'modifier': modifier, 'samples': samples, 'seed': seed}
+
+def odds_response(ids = None, player_id = None, single = False):
+    try:
+        options = _odds_options()
+    except ValueError as e:
+        return json_response(failure_body(str(e)), status = 400)
+    characters, move_ids = odds.load_party(ids = ids, player_id = player_id)
+    if single and not characters:
+        return json_response(failure_body('That character does not exist'), status = 404)
+    data = odds.character_odds(characters, move_ids, **options)
+    return json_response(success_body(data, method = 'exact' if options['samples'] is None else 'monte_carlo',
+                                      samples = options['samples'], modifier = options['modifier']))
+
+@app.route('/api/character/<character_id>/odds', methods = ['GET'])
+def get_character_odds(character_id):
+    '''
+    Miss, weak hit and strong hit chances for each of the character's moves. modifier adds to every roll,
+    method=monte_carlo simulates samples rolls (with an optional seed) instead of the exact odds
+    '''
+    logger.debug('Call to get_character_odds for %s', character_id)
+    return odds_response(ids = [character_id], single = True)
+
+@app.route('/api/characters/odds', methods = ['GET'])
+def get_party_odds():
+    ''' get_character_odds for ids=a,b,c or every character of player_id, all resolved together '''
+    logger.debug('Call to get_party_odds')
+    ids = request.args.get('ids')
+    player_id = request.args.get('player_id')
+    if not ids and not player_id:
+        return json_response(failure_body('Pass ids or player_id'), status = 400)
+    ids = list(dict.fromkeys(ids.split(','))) if ids else None
+    if ids and len(ids) > MAX_SHEETS:
+        return json_response(failure_body('At most {} ids per request'.format(MAX_SHEETS)), status = 400)
+    return odds_response(ids = ids, player_id = player_id)
+
+@app.route('/api/characters/live', methods = ['GET'])
+def live_characters():
+    '''
+    Server-sent events for ids=a,b,c instead of polling get_character: a ready event with each character's
+    ETag, then a character event with only the changed fields and new ETag whenever an edit commits
+    '''
+    logger.debug('Call to live_characters')
+    ids = list(dict.fromkeys(request.args.get('ids', '').split(','))) if request.args.get('ids') else None
+    if not ids:
+        return json_response(failure_body('Pass ids'), status = 400)
+    if len(ids) > MAX_SHEETS:
+        return json_response(failure_body('At most {} ids per request'.format(MAX_SHEETS)), status = 400)
+    sub = live.hub.subscribe(ids) # before reading the ETags, so no commit falls between the two
+    if sub is None:
+        return json_response(failure_body('Too many live streams, try again later'), status = 503,
+                             headers = {'Retry-After': '30'})
+    ready = {c.id: c.etag for c in Character.query.options(load_only('id', 'updated_at')).filter(Character.id.in_(ids))}
+    db.session.remove() # idle streams must not hold a pooled connection
+    return Response(live.stream(sub, ready), mimetype = 'text/event-stream',
+                    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/characters/export', methods = ['GET'])
+@login_required
+def export_roster():
+    ''' The logged in player's characters as NDJSON, streamed. python -m application.roster exports everyone '''
+    logger.debug('Call to export_roster for %s', current_user.id)
+    return Response(stream_with_context(export_characters(current_user.id)), mimetype = 'application/x-ndjson',
+                    headers = {'Content-Disposition': 'attachment; filename=roster.ndjson'})
+
+@app.route('/api/characters/import', methods = ['POST'])
+@login_required
+def import_roster():
+    ''' Load an NDJSON export as the logged in player's characters, existing ones are skipped '''
+    logger.debug('Call to import_roster for %s', current_user.id)
+    batches = []
+    totals = import_characters((l.decode() for l in request.stream), current_user.id,
+                               report = lambda n, stats: batches.append(stats))
+    errors = [{'line': n, 'message': m} for n, m in totals['errors']]
+    data = {'inserted': totals['inserted'], 'skipped': totals['skipped'], 'errors': errors, 'batches': batches}
+    if errors and not totals['inserted']:
+        return json_response(failure_body('No characters imported', **data), status = 400)
+    return json_response(success_body(data))
 
 @app.route('/api/character/<character_id>', methods = ['POST']) 
 def update_character(character_id):
     ''' ZZ docstring '''
-    logger.debug(f'Call to update_character for {character_id}')
+    logger.debug('Call to update_character for %s', character_id)
     character = Character.get(character_id)
     if not character:
         return json.dumps({'status': 'failure', 'message': 'That character does not exist'})
+    changes = {}
     for k, v in request.args.items():
         if k == 'playbook':
             playbook = Playbook.get_name(v)
-            character.playbook_id = playbook.id
+            changes['playbook_id'] = playbook.id
         elif k not in character.mutable_columns:
             return json.dumps({'status': 'failure', 'message': 'Invalid argument: {}'.format(k)})
         else:
-            character.set(k, v)
+            changes[k] = v
+    character.apply_changes(changes)
     db.session.commit()
     logger.debug('Character updated')
     return get_character(character_id)
 
+def _patch_changes(character, body):
+    ''' {column: value} changes from a PATCH body, raises ValueError. Values are checked by Character.check_changes '''
+    if not isinstance(body, dict) or not body:
+        raise ValueError('Body must be a JSON object of fields to change')
+    changes = {}
+    for k, v in body.items():
+        if k == 'playbook':
+            playbook = Playbook.get_name(v) if isinstance(v, str) else None
+            if not playbook:
+                raise ValueError('Unknown playbook: {}'.format(v))
+            changes['playbook_id'] = playbook.id
+        elif k not in character.mutable_columns:
+            raise ValueError('Invalid field: {}'.format(k))
+        else:
+            changes[k] = v
+    return changes
+
+@app.route('/api/character/<character_id>', methods = ['PATCH'])
+def patch_character(character_id):
+    '''
+    Change many fields at once from a JSON body. If-Match must carry the ETag from the last read (or * to
+    overwrite regardless); a character changed by someone else since answers 412 with the current ETag.
+    Responds with only the fields that changed and the new ETag
+    '''
+    logger.debug('Call to patch_character for %s', character_id)
+    character = Character.get(character_id)
+    if not character:
+        return json_response(failure_body('That character does not exist'), status = 404)
+    if_match = request.headers.get('If-Match')
+    if not if_match:
+        return json_response(failure_body('If-Match header required'), status = 428)
+    if if_match.strip() != '*' and character.etag not in [t.strip() for t in if_match.split(',')]:
+        return json_response(failure_body('Character was changed by someone else'), status = 412,
+                             headers = {'ETag': character.etag})
+    try:
+        changes = _patch_changes(character, request.get_json(silent = True))
+    except ValueError as e:
+        return json_response(failure_body(str(e)), status = 400)
+    errors = character.check_changes(changes)
+    if errors:
+        return json_response(failure_body('Invalid field values', errors = errors), status = 400)
+    try:
+        updated = character.apply_changes(changes, if_unmodified = if_match.strip() != '*')
+    except StaleCharacter:
+        db.session.rollback()
+        return json_response(failure_body('Character was changed by someone else'), status = 412,
+                             headers = {'ETag': Character.get(character_id).etag})
+    data = {k: v for k, v in character.to_dict().items() if k in updated} # before commit expires the instance
+    etag = character.etag
+    db.session.commit()
+    logger.debug('Patched %s: %s', character_id, sorted(updated))
+    return json_response(success_body(data), headers = {'ETag': etag})
+
+def catalog_response(key, build):
+    ''' Serve a pre-serialized catalog body with ETag/conditional GET support, 404 if build finds nothing '''
+    prepared = catalog.prepared(key, build)
+    if prepared is None:
+        abort(404)
+    return prepared_response(prepared, max_age = CATALOG_CHECK_INTERVAL)
+
+def catalog_item_body(cls, id):
+    obj = cls.get(id)
+    return success_body(serialize(obj)) if obj else None
+
+LIST_ARGS = ['fields', 'ids', 'after', 'limit']
+
+def list_response(cls, key):
+    '''
+    Full catalog lists are served pre-serialized. With query args the listing goes through DbMixIn.list_rows:
+    fields=a,b projects columns, ids=x,y batch fetches, after=<id>&limit=n pages, anything else filters (comma = any of).
+    '''
+    if not request.args:
+        return catalog_response(key, lambda: success_body(serialize(cls.get_all())))
+    split = lambda v: v.split(',') if v else None
+    filters = {k: (v.split(',') if ',' in v else v) for k, v in request.args.items() if k not in LIST_ARGS}
+    try:
+        rows, next_cursor = cls.list_rows(
+            filters = filters,
+            fields = split(request.args.get('fields')),
+            ids = split(request.args.get('ids')),
+            after = request.args.get('after'),
+            limit = request.args.get('limit')
+        )
+    except ValueError as e:
+        return json_response(failure_body(str(e)), status = 400)
+    return json_response(success_body(rows, next = next_cursor))
+
 @app.route('/api/playbook', methods = ['GET'])
 def get_playbooks():
     logger.debug('Call to get_playbooks')
-    playbooks = Playbook.get_all()
-    data = [p.to_dict() for p in playbooks]
-    resp = {'status': 'success', 'data': data}
-    return json.dumps(resp)
+    return list_response(Playbook, 'playbooks')
 
 @app.route('/api/playbook/<playbook_id>', methods = ['GET'])
 def get_playbook(playbook_id):
     ''' docstring '''
     logger.debug('Call to get_playbook')
-    playbook = Playbook.get(playbook_id)
-    data = playbook.to_dict()
-    resp = {'status': 'success', 'data': data}
-    return json.dumps(resp)
+    return catalog_response(('playbook', playbook_id), lambda: catalog_item_body(Playbook, playbook_id))
 
 @app.route('/api/technique', methods = ['GET'])
 def get_techniques():
     ''' docstring '''
     logger.debug('Call to get_techniques')
-    techniques = Technique.get_all()
-    data = [t.to_dict() for t in techniques]
-    resp = {'status': 'success', 'data': data}
-    return json.dumps(resp)  
+    return list_response(Technique, 'techniques')
 
 @app.route('/api/technique/<technique_id>', methods = ['GET'])
 def get_technique(technique_id):  
-    logger.debug('Call to get_technique {technique_id}')
-    technique = Technique.get(technique_id)
-    data = technique.to_dict()
-    resp = {'status': 'success', 'data': data}
-    return json.dumps(resp)
+    logger.debug('Call to get_technique %s', technique_id)
+    return catalog_response(('technique', technique_id), lambda: catalog_item_body(Technique, technique_id))
 
 @app.route('/api/move', methods = ['GET'])
 def get_moves():
     ''' docstring '''
     logger.debug('Call to get_moves')
-    moves = Move.get_all()
-    data = [m.to_dict() for m in moves]
-    resp = {'status': 'success', 'data': data}
-    return json.dumps(resp)
+    return list_response(Move, 'moves')
 
 @app.route('/api/move/<move_id>', methods = ['GET'])
 def get_move(move_id):
     ''' docstring '''
-    logger.debug('Call to get_move {move_id}')
-    move = Move.get(move_id)
-    data = move.to_dict()
-    resp = {'status': 'success', 'data': data}
-    return json.dumps(resp)
+    logger.debug('Call to get_move %s', move_id)
+    return catalog_response(('move', move_id), lambda: catalog_item_body(Move, move_id))
 
 @app.route('/api/character/<character_id>/moves', methods = ['GET'])
 def get_character_moves(character_id):
     ''' docstring '''
     logger.debug('Call to get_character_moves')
-    character = Character.get(character_id)
-    data = [m.to_dict() for m in character.moves]
-    resp = {'status': 'success', 'data': data}
-    return json.dumps(resp)
+    character = Character.get(character_id, options = [selectinload(Character.move_rows)])
+    return json_response(success_body(serialize(character.catalog_moves)))
 
 @app.route('/api/character/<character_id>/moves', methods = ['POST'])
 def add_character_move(character_id):
@@ -255,17 +447,15 @@ def add_character_move(character_id):
         resp = {'status': 'success', 'data': {}}
     else:
         resp = {'status': 'failure', 'message': 'Move already associated with character'}
-    logger.debug(f'Inserted {move_id} for {character_id}')
+    logger.debug('Inserted %s for %s', move_id, character_id)
     return json.dumps(resp)
 
 @app.route('/api/character/<character_id>/techniques', methods = ['GET'])
 def get_character_techniques(character_id):
     ''' docstring '''
     logger.debug('Call to get_character_techniques')
-    character = Character.get(character_id)
-    data = [t.to_dict() for t in character.techniques]
-    resp = {'status': 'success', 'data': data}
-    return json.dumps(resp)
+    character = Character.get(character_id, options = [selectinload(Character.technique_rows)])
+    return json_response(success_body(serialize([t for t, mastery in character.catalog_techniques])))
 
 @app.route('/api/character/<character_id>/techniques', methods = ['POST'])
 def add_character_technique(character_id):
@@ -286,5 +476,5 @@ def add_character_technique(character_id):
     db.session.add(ct)
     db.session.commit()
     resp = {'status': 'success', 'data': {}}
-    logger.debug(f'{character_id} has learned {technique_id}')
+    logger.debug('%s has learned %s', character_id, technique_id)
     return json.dumps(resp)
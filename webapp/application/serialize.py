@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import json
+import gzip
+import hashlib
+import threading
+from datetime import datetime
+from flask import Response, request
+from sqlalchemy import types
+
+from . import compression
+
+try: # optional, several times faster than the stdlib encoder
+    import orjson
+except ImportError:
+    orjson = None
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def _conv_datetime(v):
+    return v.strftime(TIMESTAMP_FORMAT) if isinstance(v, datetime) else v
+
+def _converter(column_type):
+    ''' Returns a value converter for a column type, or None when values are already JSON-safe '''
+    if isinstance(column_type, (types.DateTime, types.Date)):
+        return _conv_datetime
+    if isinstance(column_type, types.Enum) and column_type.enum_class is not None:
+        return lambda v: v.value if v is not None else None
+    # JSON columns come back as python lists/dicts, strings and numbers need nothing
+    return None
+
+class ModelSerializer(object):
+    '''
+    Fixed field plan for one model class, compiled once from its table.
+    fields optionally projects to a subset of columns.
+    '''
+
+    def __init__(self, cls, fields = None):
+        columns = {c.key: c for c in cls.__table__.columns}
+        if fields is None:
+            fields = list(columns)
+        unknown = [f for f in fields if f not in columns]
+        if unknown:
+            raise ValueError('Unknown fields for {}: {}'.format(cls.__name__, ', '.join(unknown)))
+        self.cls = cls
+        self.fields = tuple(fields)
+        self.plain = tuple(f for f in self.fields if _converter(columns[f].type) is None)
+        self.converted = tuple((f, _converter(columns[f].type)) for f in self.fields if _converter(columns[f].type) is not None)
+
+    def to_dict(self, obj):
+        d = {f: getattr(obj, f) for f in self.plain}
+        for f, conv in self.converted:
+            d[f] = conv(getattr(obj, f))
+        return d
+
+    def to_dicts(self, objs):
+        return [self.to_dict(o) for o in objs]
+
+# compiled serializers kept, the oldest is dropped past this. fields come from query strings, so bound them
+SERIALIZER_CACHE_SIZE = 256
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def serializer_for(cls, fields = None):
+    if fields is not None:
+        # one key per set of columns in table order, however the client orders or repeats them
+        order = {c.key: i for i, c in enumerate(cls.__table__.columns)}
+        fields = sorted(set(fields), key = lambda f: order.get(f, len(order)))
+    key = (cls, tuple(fields) if fields is not None else None)
+    s = _registry.get(key)
+    if s is None:
+        with _registry_lock:
+            s = _registry.get(key) or ModelSerializer(cls, fields)
+            if key not in _registry and len(_registry) >= SERIALIZER_CACHE_SIZE:
+                del _registry[next(iter(_registry))]
+            _registry[key] = s
+    return s
+
+def dumps(payload):
+    ''' Encode straight to JSON bytes '''
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators = (',', ':')).encode()
+
+def serialize(obj_or_objs, fields = None):
+    ''' Model instance or list of instances to JSON-safe dicts '''
+    if isinstance(obj_or_objs, (list, tuple)):
+        if not obj_or_objs:
+            return []
+        return serializer_for(type(obj_or_objs[0]), fields).to_dicts(obj_or_objs)
+    return serializer_for(type(obj_or_objs), fields).to_dict(obj_or_objs)
+
+def success_body(data, **extra):
+    return dumps(dict({'status': 'success', 'data': data}, **extra))
+
+def failure_body(message, **extra):
+    return dumps(dict({'status': 'failure', 'message': message}, **extra))
+
+def json_response(body, status = 200, headers = None):
+    return Response(body, status = status, mimetype = 'application/json', headers = headers)
+
+class PreparedBody(object):
+    '''
+    Encoded response body with a strong ETag and gzip and brotli variants, computed once and served many times.
+    Built once per catalog version, so the slower high compression settings are worth it here
+    '''
+
+    def __init__(self, body, compresslevel = 9, brotli_quality = 9):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.variants = {None: (body, self.etag), 'gzip': (gzip.compress(body, compresslevel), self.etag + '-gz')}
+        if compression.brotli is not None:
+            self.variants['br'] = (compression.brotli.compress(body, quality = brotli_quality), self.etag + '-br')
+
+def prepared_response(prepared, max_age = 60):
+    ''' Serve a PreparedBody, answering If-None-Match with 304 and picking the best encoding the client accepts '''
+    encoding = compression.negotiate()
+    body, etag = prepared.variants.get(encoding, prepared.variants[None])
+    if any(request.if_none_match.contains(e) for _, e in prepared.variants.values()):
+        resp = Response(status = 304)
+    else:
+        resp = json_response(body)
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'public, max-age={}'.format(int(max_age))
+    resp.vary.add('Accept-Encoding')
+    return resp
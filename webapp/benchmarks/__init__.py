@@ -0,0 +1,7 @@
+'''
+Local benchmarks against a temporary SQLite file or a local MySQL (--db-uri). Run from webapp/:
+
+    python -m benchmarks --output results.json     full suite as JSON, see __main__.py
+    python -m benchmarks.compare a.json b.json     flag p50/p99 regressions between two runs
+    python -m benchmarks.bench_routes              single modules print a readable report
+'''
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''
+Full benchmark suite, results as JSON for comparing branches:
+
+    python -m benchmarks --players 1000 --characters-per-player 10 --output results.json
+    python -m benchmarks.compare baseline.json results.json
+
+--db-uri points it at a local MySQL instead of a temporary SQLite file. Exits non-zero when a check fails,
+a page going over its statement bound or a hot query that cannot use an index, after writing the results.
+'''
+
+import sys
+import json
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from . import harness, bench_routes, bench_serializer, bench_available_techniques, bench_page_queries, bench_compression, bench_live, bench_odds
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = harness.WEBAPP_DIR,
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks', description = 'Avatar Legends helper benchmarks')
+    parser.add_argument('--db-uri', help = 'database to benchmark against, default a temporary sqlite file')
+    parser.add_argument('--players', type = int, default = 100)
+    parser.add_argument('--characters-per-player', type = int, default = 10)
+    parser.add_argument('--requests', type = int, default = 200, help = 'requests per route')
+    parser.add_argument('--threads', type = int, default = 1, help = 'concurrent clients per route')
+    parser.add_argument('--routes', nargs = '*', help = 'only these routes, by name')
+    parser.add_argument('--skip-micro', action = 'store_true', help = 'only run the route load test')
+    parser.add_argument('--output', help = 'write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    app = harness.boot(args.db_uri)
+    failures = []
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'started_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'database': args.db_uri or 'sqlite (temporary)'
+        }
+    }
+    if not args.skip_micro:
+        results['micro'] = {
+            'serializer': bench_serializer.run(app),
+            'available_techniques': bench_available_techniques.run(app),
+            'page_statements': bench_page_queries.run(app),
+            'compression': bench_compression.run(app),
+            'live': bench_live.run(app),
+            'odds': bench_odds.run(app)
+        }
+        over = bench_page_queries.over_bounds(results['micro']['page_statements'])
+        if over:
+            failures.append('statements per page over bound {}: {}'.format(bench_page_queries.BOUNDS, over))
+    load = bench_routes.run(app, n_players = args.players, characters_per_player = args.characters_per_player,
+                            n_requests = args.requests, n_threads = args.threads, routes = args.routes)
+    results['meta'].update(load['meta'])
+    results['routes'] = load['routes']
+    from application import migrations # after boot, which sets up the app's environment
+    with app.app_context():
+        plans = migrations.plans()
+    results['query_plans'] = {name: plan for name, _, plan in plans}
+    scans = [name for name, ok, _ in plans if not ok]
+    if scans:
+        failures.append('hot queries without a usable index: {}'.format(', '.join(scans)))
+    results['failures'] = failures
+
+    body = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        sys.stdout.write(body + '\n')
+    for f in failures:
+        sys.stderr.write('FAILED {}\n'.format(f))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+''' Query count and latency of technique eligibility lookups on the edit page '''
+
+import time
+from .harness import boot, seed_catalog, StatementCounter, report
+
+N_CALLS = 1000
+N_CHARACTERS = 50
+
+def run(app):
+    from application import db
+    from application.db_model import Player, Character, Playbook, catalog, trainings
+    from application.forms import CharacterEditForm
+    with app.app_context():
+        seed_catalog()
+        player_id = Player.make_id('bench_techniques')
+        if not Player.get(player_id):
+            db.session.add(Player('bench_techniques', 'benchmark'))
+            db.session.commit()
+        playbooks = Playbook.get_all()
+        if not Character.query.filter_by(player_id = player_id).first():
+            Character.create_with_defaults(player_id, [
+                {'name': 'Character {}'.format(i), 'playbook_id': playbooks[i % len(playbooks)].id, 'training': trainings[i % len(trainings)]}
+                for i in range(N_CHARACTERS)
+            ])
+        characters = Character.query.filter_by(player_id = player_id).all()
+        catalog.snapshot() # warm
+
+        results = {}
+        character = characters[0]
+        with StatementCounter(db.engine) as q:
+            start = time.perf_counter()
+            for _ in range(N_CALLS):
+                character.available_techniques(include_known = True)
+            results['include_known=True us/call'] = round((time.perf_counter() - start) / N_CALLS * 1e6, 2)
+        results['include_known=True queries'] = q.count
+
+        with app.test_request_context('/character/{}/edit'.format(character.id)):
+            with StatementCounter(db.engine) as q:
+                form = CharacterEditForm()
+                form.set_choices(character)
+            results['set_choices technique queries'] = sum('techniques' in s for s in q.statements)
+
+        db.session.expire_all()
+        characters = Character.query.filter_by(player_id = player_id).all()
+        with StatementCounter(db.engine) as q:
+            start = time.perf_counter()
+            Character.available_techniques_for(characters)
+            results['batch of {} ms'.format(N_CHARACTERS)] = round((time.perf_counter() - start) * 1e3, 3)
+        results['batch of {} queries'.format(N_CHARACTERS)] = q.count
+        db.session.remove()
+    return results
+
+def main():
+    report('available_techniques', run(boot()))
+
+if __name__ == '__main__':
+    main()
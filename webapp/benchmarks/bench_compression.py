@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+'''
+Bytes and time saved by response compression. Server time is measured in-process, transfer time is estimated
+from the body size at LINK_MBPS, roughly a phone on a busy table's wifi
+'''
+
+import time
+from .harness import boot, seed_catalog, seed_players, percentile, report
+
+N_REQUESTS = 100
+LINK_MBPS = 10
+ENCODINGS = ['identity', 'gzip', 'br']
+
+def _measure(client, path, encoding):
+    latencies = []
+    for _ in range(N_REQUESTS):
+        start = time.perf_counter()
+        resp = client.get(path, headers = {'Accept-Encoding': encoding})
+        latencies.append(time.perf_counter() - start)
+    size = len(resp.get_data())
+    server_ms = percentile(sorted(latencies), 50) * 1e3
+    transfer_ms = size * 8 / (LINK_MBPS * 1e6) * 1e3
+    return {'encoding': resp.headers.get('Content-Encoding', 'identity'), 'bytes': size,
+            'server_p50_ms': round(server_ms, 3), 'transfer_ms': round(transfer_ms, 2),
+            'total_ms': round(server_ms + transfer_ms, 2)}
+
+def run(app):
+    from application import db
+    from application.db_model import Character
+    with app.app_context():
+        seed_catalog()
+        player_id = seed_players(1, 1, password = 'benchmark', prefix = 'compress')[0]
+        character_id = Character.query.filter_by(player_id = player_id).first().id
+        db.session.remove()
+    client = app.test_client()
+    client.post('/login', data = {'name': 'compress0', 'password': 'benchmark'})
+    paths = {
+        '/api/technique (prepared)': '/api/technique',
+        '/api/technique (filtered)': '/api/technique?approach=Advance and Attack&limit=1000',
+        'character_edit page': '/character/{}/edit'.format(character_id),
+    }
+    results = {}
+    for name, path in paths.items():
+        by_encoding = {e: _measure(client, path, e) for e in ENCODINGS}
+        plain = by_encoding['identity']
+        for e, r in by_encoding.items():
+            r['bytes_saved'] = plain['bytes'] - r['bytes']
+            r['ms_saved'] = round(plain['total_ms'] - r['total_ms'], 2)
+        results[name] = by_encoding
+    return results
+
+def main():
+    for name, by_encoding in run(boot()).items():
+        report(name, {e: r for e, r in by_encoding.items()})
+
+if __name__ == '__main__':
+    main()
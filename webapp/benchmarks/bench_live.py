@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''
+Live character streams against polling. Measures how long a PATCH takes to reach an open stream, what one poll
+of get_character costs, and the hub's memory per idle stream and fan-out time to many streams of one character
+'''
+
+import time
+import queue
+import threading
+import tracemalloc
+from .harness import boot, seed_catalog, seed_players, percentile, report
+
+N_PATCHES = 50
+N_POLLS = 200
+N_STREAMS = 5000
+N_PUBLISHES = 20
+
+def _events(resp, out):
+    ''' Parse the event stream into (name, data) pairs on out '''
+    buf = b''
+    for chunk in resp.response:
+        buf += chunk
+        while b'\n\n' in buf:
+            block, buf = buf.split(b'\n\n', 1)
+            fields = dict(line.split(b': ', 1) for line in block.split(b'\n') if b': ' in line and not line.startswith(b':'))
+            if b'event' in fields:
+                out.put((fields[b'event'].decode(), fields[b'data'], time.perf_counter()))
+
+def _push(app, character_id):
+    client = app.test_client()
+    resp = client.get('/api/characters/live?ids={}'.format(character_id), buffered = False)
+    events = queue.Queue()
+    threading.Thread(target = _events, args = (resp, events), daemon = True).start()
+    name, data, _ = events.get(timeout = 5)
+    assert name == 'ready' and character_id.encode() in data, (name, data)
+    latencies, sizes = [], []
+    for i in range(N_PATCHES):
+        start = time.perf_counter()
+        r = client.patch('/api/character/{}'.format(character_id), json = {'fatigue': i % 5 + 1}, headers = {'If-Match': '*'})
+        assert r.status_code == 200, r.get_data()
+        name, data, received = events.get(timeout = 5)
+        assert name == 'character' and b'"fatigue"' in data and b'"name"' not in data, data
+        latencies.append(received - start)
+        sizes.append(len(data))
+    # the stream stays open, closing it here would race the reader thread
+    latencies.sort()
+    return {'events': len(latencies), 'patch_to_event_p50_ms': round(percentile(latencies, 50) * 1e3, 3),
+            'patch_to_event_p95_ms': round(percentile(latencies, 95) * 1e3, 3), 'event_bytes': max(sizes)}
+
+def _poll(app, character_id):
+    client = app.test_client()
+    latencies = []
+    for _ in range(N_POLLS):
+        start = time.perf_counter()
+        resp = client.get('/api/character/{}'.format(character_id))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {'poll_p50_ms': round(percentile(latencies, 50) * 1e3, 3), 'poll_bytes': len(resp.get_data())}
+
+def _hub():
+    from application.live import LocalHub
+    hub = LocalHub(max_streams = N_STREAMS)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    subs = [hub.subscribe(['character{}'.format(i % 50)]) for i in range(N_STREAMS)]
+    per_stream = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(before, 'filename')) / N_STREAMS
+    tracemalloc.stop()
+    fanout = []
+    for i in range(N_PUBLISHES):
+        start = time.perf_counter()
+        hub.publish([{'id': 'character0', 'etag': '"{}"'.format(i), 'data': {'fatigue': i % 5}}])
+        fanout.append(time.perf_counter() - start)
+    received = sum(len(hub.wait(s, 0)) for s in subs) # merged, one pending delta per stream
+    for s in subs:
+        hub.unsubscribe(s)
+    return {'streams': N_STREAMS, 'bytes_per_idle_stream': int(per_stream), 'fanout_streams': received,
+            'fanout_p50_ms': round(percentile(sorted(fanout), 50) * 1e3, 3)}
+
+def run(app):
+    from application import db
+    from application.db_model import Character
+    with app.app_context():
+        seed_catalog()
+        player_id = seed_players(1, 1, password = 'benchmark', prefix = 'live')[0]
+        character_id = Character.query.filter_by(player_id = player_id).first().id
+        db.session.remove()
+    return {'push': _push(app, character_id), 'poll': _poll(app, character_id), 'hub': _hub()}
+
+def main():
+    for name, row in run(boot()).items():
+        report(name, row)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''
+Roll odds for a whole campaign: the engine alone on loaded characters, and the party endpoint end to end.
+Also reports how far the monte carlo odds land from the exact ones
+'''
+
+import time
+from .harness import boot, seed_catalog, seed_players, percentile, report
+
+N_CHARACTERS = 50
+N_RUNS = 50
+SAMPLES = 100000
+
+def _p50_ms(fn):
+    latencies = []
+    for _ in range(N_RUNS):
+        start = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - start)
+    return round(percentile(sorted(latencies), 50) * 1e3, 3), result
+
+def _max_error(exact, simulated):
+    return max(abs(a[k] - b[k]) for x, y in zip(exact, simulated) for a, b in zip(x['moves'], y['moves'])
+               for k in ('miss', 'weak_hit', 'strong_hit') if a[k] is not None)
+
+def run(app):
+    from application import db, odds
+    with app.app_context():
+        seed_catalog()
+        player_id = seed_players(1, N_CHARACTERS, password = 'benchmark', prefix = 'odds')[0]
+        characters, move_ids = odds.load_party(player_id = player_id)
+        exact_ms, exact = _p50_ms(lambda: odds.character_odds(characters, move_ids))
+        simulated_ms, simulated = _p50_ms(lambda: odds.character_odds(characters, move_ids, samples = SAMPLES, seed = 1))
+        load_ms, _ = _p50_ms(lambda: odds.load_party(player_id = player_id))
+        results = {
+            'characters': len(characters),
+            'rolls': sum(len(c['moves']) for c in exact),
+            'load_party_p50_ms': load_ms,
+            'engine_exact_p50_ms': exact_ms,
+            'engine_monte_carlo_p50_ms': simulated_ms,
+            'monte_carlo_samples': SAMPLES,
+            'monte_carlo_max_error': round(_max_error(exact, simulated), 4)
+        }
+        db.session.remove()
+    client = app.test_client()
+    for method in ['exact', 'monte_carlo']:
+        path = '/api/characters/odds?player_id={}&method={}'.format(player_id, method)
+        results['endpoint_{}_p50_ms'.format(method)], resp = _p50_ms(lambda: client.get(path))
+        assert resp.status_code == 200, resp.get_data()
+    return results
+
+def main():
+    report('party odds', run(boot()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+''' Statement counts for the home and edit pages. Exits non-zero if a page exceeds its bound '''
+
+import sys
+from .harness import boot, seed_catalog, StatementCounter, report
+
+N_CHARACTERS = 25
+# load_user + the page's own queries, independent of N_CHARACTERS
+BOUNDS = {'home': 3, 'edit_character': 3}
+
+def run(app):
+    from application import db
+    from application.db_model import Player, Character, Playbook, catalog
+    with app.app_context():
+        seed_catalog()
+        playbooks = Playbook.get_all()
+        client = app.test_client()
+        client.post('/register', data = {'name': 'bench_pages', 'password': 'pw', 'confirm': 'pw'})
+        client.post('/login', data = {'name': 'bench_pages', 'password': 'pw'})
+        player_id = Player.make_id('bench_pages')
+        if not Character.query.filter_by(player_id = player_id).first():
+            Character.create_with_defaults(player_id,
+                [('Character {}'.format(i), playbooks[i % len(playbooks)].id) for i in range(N_CHARACTERS)])
+        character_id = Character.make_id(player_id, 'Character 0')
+        catalog.snapshot() # warm
+        db.session.remove()
+
+        counts = {}
+        for name, url in [('home', '/home'), ('edit_character', '/character/{}/edit'.format(character_id))]:
+            with StatementCounter(db.engine) as q:
+                resp = client.get(url)
+            assert resp.status_code == 200, (url, resp.status_code)
+            counts[name] = q.count
+    return counts
+
+def over_bounds(counts):
+    ''' {page: count} for pages over their bound, empty when every page is within it '''
+    return {k: v for k, v in counts.items() if v > BOUNDS[k]}
+
+def main():
+    counts = run(boot())
+    report('statements per page ({} characters)'.format(N_CHARACTERS), counts)
+    over = over_bounds(counts)
+    if over:
+        print('over bound: {}'.format(over))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+''' Throughput and p50/p99 latency for every route, through the WSGI app in-process '''
+
+import time
+import json
+import threading
+from .harness import boot, seed_catalog, seed_players, summarize, report
+
+PASSWORD = 'benchmark'
+
+def route_table(ctx):
+    '''
+    (name, method, path builder, body builder[, headers builder]) per route. Builders take the worker's context and
+    the request number so create/register requests stay unique. Bodies are form data, or sent as is when a string
+    '''
+    c = lambda w, i: w['character_ids'][i % len(w['character_ids'])]
+    # If-Match from the ETag the worker last saw for the path, get_character runs first to fill them in
+    patch_headers = lambda w, i: {'If-Match': w['etags'].get('/api/character/{}'.format(c(w, i)), '*'),
+                                  'Content-Type': 'application/json'}
+    roster = lambda w, i: ''.join(json.dumps({'name': 'Imported {} {} {}'.format(w['n'], i, k), 'moves': [], 'techniques': {},
+                                              'playbook_id': ctx['playbook_ids'][k % len(ctx['playbook_ids'])]}) + '\n'
+                                  for k in range(10))
+    return [
+        ('index', 'GET', lambda w, i: '/', None),
+        ('login', 'POST', lambda w, i: '/login', lambda w, i: {'name': w['player_name'], 'password': PASSWORD}),
+        ('register', 'POST', lambda w, i: '/register',
+            lambda w, i: {'name': 'new{}x{}'.format(w['n'], i), 'password': PASSWORD, 'confirm': PASSWORD}),
+        ('home', 'GET', lambda w, i: '/home', None),
+        ('create_character', 'POST', lambda w, i: '/character/create',
+            lambda w, i: {'name': 'New {} {}'.format(w['n'], i), 'playbook_id': ctx['playbook_ids'][i % len(ctx['playbook_ids'])]}),
+        ('edit_character GET', 'GET', lambda w, i: '/character/{}/edit'.format(c(w, i)), None),
+        ('edit_character POST', 'POST', lambda w, i: '/character/{}/edit'.format(c(w, i)),
+            lambda w, i: {'fighting_style': 'Style {}'.format(i), 'hometown': 'Ba Sing Se'}),
+        ('get_character', 'GET', lambda w, i: '/api/character/{}'.format(c(w, i)), None),
+        ('patch_character', 'PATCH', lambda w, i: '/api/character/{}'.format(c(w, i)),
+            lambda w, i: json.dumps({'fatigue': i % 5, 'hometown': 'Town {}'.format(i)}), patch_headers),
+        ('update_character', 'POST', lambda w, i: '/api/character/{}?fatigue={}'.format(c(w, i), i % 5), None),
+        ('get_characters', 'GET', lambda w, i: '/api/characters?ids={}'.format(','.join(w['character_ids'][:10])), None),
+        ('get_character_moves', 'GET', lambda w, i: '/api/character/{}/moves'.format(c(w, i)), None),
+        ('get_character_techniques', 'GET', lambda w, i: '/api/character/{}/techniques'.format(c(w, i)), None),
+        ('get_character_odds', 'GET', lambda w, i: '/api/character/{}/odds'.format(c(w, i)), None),
+        ('get_character_odds monte_carlo', 'GET', lambda w, i: '/api/character/{}/odds?method=monte_carlo&seed={}'.format(c(w, i), i), None),
+        ('get_party_odds', 'GET', lambda w, i: '/api/characters/odds?player_id={}'.format(w['player_id']), None),
+        ('live_characters', 'GET', lambda w, i: '/api/characters/live?ids={}'.format(','.join(w['character_ids'][:10])), None),
+        ('export_roster', 'GET', lambda w, i: '/api/characters/export', None),
+        ('import_roster', 'POST', lambda w, i: '/api/characters/import', roster),
+        ('get_playbooks', 'GET', lambda w, i: '/api/playbook', None),
+        ('get_playbook', 'GET', lambda w, i: '/api/playbook/{}'.format(ctx['playbook_ids'][i % len(ctx['playbook_ids'])]), None),
+        ('get_techniques', 'GET', lambda w, i: '/api/technique', None),
+        ('get_techniques filtered', 'GET', lambda w, i: '/api/technique?req_training=Firebending&fields=id,name', None),
+        ('get_technique', 'GET', lambda w, i: '/api/technique/{}'.format(ctx['technique_ids'][i % len(ctx['technique_ids'])]), None),
+        ('get_moves', 'GET', lambda w, i: '/api/move', None),
+        ('get_move', 'GET', lambda w, i: '/api/move/{}'.format(ctx['move_ids'][i % len(ctx['move_ids'])]), None),
+        ('metrics', 'GET', lambda w, i: '/metrics', None),
+    ]
+
+def _read(resp):
+    ''' Consume the body. Event streams never end, they are read up to their first event and closed '''
+    if resp.mimetype == 'text/event-stream':
+        for chunk in resp.response:
+            if chunk.startswith(b'event:'):
+                break
+    else:
+        resp.get_data()
+    resp.close()
+
+def _worker(app, w, method, path, data, headers, n_requests, latencies, errors):
+    client = w['client']
+    for i in range(n_requests):
+        url = path(w, i)
+        start = time.perf_counter()
+        resp = client.open(url, method = method, data = data(w, i) if data else None,
+                           headers = headers(w, i) if headers else None, buffered = False)
+        _read(resp)
+        latencies.append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            errors.append(resp.status_code)
+        if 'ETag' in resp.headers:
+            w['etags'][url] = resp.headers['ETag']
+
+def run(app, n_players = 100, characters_per_player = 10, n_requests = 200, n_threads = 1, routes = None):
+    from application import db, live
+    from application.db_model import Playbook, Move, Technique, Character
+    # each client thread holds at most one live stream at a time, the cap sized for gthread request threads does not apply
+    live.hub.max_streams = max(live.hub.max_streams, n_threads)
+    with app.app_context():
+        seed_catalog()
+        start = time.perf_counter()
+        player_ids = seed_players(n_players, characters_per_player, password = PASSWORD, prefix = 'load')
+        seed_seconds = time.perf_counter() - start
+        ctx = {
+            'playbook_ids': [p.id for p in Playbook.get_all()],
+            'move_ids': [m.id for m in Move.get_all()],
+            'technique_ids': [t.id for t in Technique.get_all()]
+        }
+        workers = []
+        for n in range(n_threads):
+            player_id = player_ids[n % len(player_ids)]
+            w = {'n': n, 'player_name': 'load{}'.format(n % len(player_ids)), 'player_id': player_id,
+                 'client': app.test_client(), 'etags': {},
+                 'character_ids': [c.id for c in Character.query.filter_by(player_id = player_id)]}
+            w['client'].post('/login', data = {'name': w['player_name'], 'password': PASSWORD})
+            workers.append(w)
+        db.session.remove()
+
+    results = {}
+    for name, method, path, data, *headers in route_table(ctx):
+        if routes and name not in routes:
+            continue
+        latencies, errors = [], []
+        per_thread = max(1, n_requests // n_threads)
+        threads = [threading.Thread(target = _worker, args = (app, w, method, path, data, headers[0] if headers else None,
+                                                              per_thread, latencies, errors))
+                   for w in workers]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        results[name] = summarize(latencies, time.perf_counter() - start, len(errors))
+        # logging in or registering switches the session user, log the worker back in as its own player
+        if name in ('register', 'login'):
+            for w in workers:
+                w['client'].post('/login', data = {'name': w['player_name'], 'password': PASSWORD})
+    meta = {'players': n_players, 'characters': n_players * characters_per_player, 'requests_per_route': n_requests,
+            'threads': n_threads, 'seed_seconds': round(seed_seconds, 2)}
+    return {'meta': meta, 'routes': results}
+
+def main():
+    out = run(boot())
+    report('seed', out['meta'])
+    for name, r in out['routes'].items():
+        print('  {:<28} {:>8} rps  p50 {:>8} ms  p99 {:>8} ms  errors {}'.format(name, r['rps'], r['p50_ms'], r['p99_ms'], r['errors']))
+
+if __name__ == '__main__':
+    main()
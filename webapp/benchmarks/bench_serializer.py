@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+''' Compiled serializer vs the original DbMixIn.to_dict + json.dumps '''
+
+import json
+import time
+from datetime import datetime
+from .harness import boot, seed_catalog, report
+
+N_ROUNDS = 200
+
+def legacy_to_dict(obj):
+    ''' DbMixIn.to_dict before the serializer registry '''
+    columns = lambda: [c.key for c in obj.__table__.columns]
+    conv_ts = lambda v: v.strftime('%Y-%m-%d %H:%M:%S') if isinstance(v, datetime) else v
+    return {k: conv_ts(v) for k, v in obj.__dict__.items() if k in columns()}
+
+def per_round(fn):
+    start = time.perf_counter()
+    for _ in range(N_ROUNDS):
+        fn()
+    return round((time.perf_counter() - start) / N_ROUNDS * 1e3, 3)
+
+def run(app):
+    from application import serialize
+    from application.db_model import Technique
+    with app.app_context():
+        seed_catalog()
+        techniques = Technique.get_all()
+        results = {
+            'rows': len(techniques),
+            'encoder': 'orjson' if serialize.orjson else 'json',
+            'legacy to_dict ms': per_round(lambda: [legacy_to_dict(t) for t in techniques]),
+            'compiled to_dict ms': per_round(lambda: serialize.serialize(techniques)),
+            'legacy to_dict + json.dumps ms': per_round(
+                lambda: json.dumps({'status': 'success', 'data': [legacy_to_dict(t) for t in techniques]})),
+            'compiled + dumps to bytes ms': per_round(lambda: serialize.success_body(serialize.serialize(techniques))),
+            'projected (id, name) ms': per_round(lambda: serialize.success_body(serialize.serialize(techniques, ['id', 'name']))),
+        }
+    return results
+
+def main():
+    report('serializer, /api/technique payload', run(boot()))
+
+if __name__ == '__main__':
+    main()
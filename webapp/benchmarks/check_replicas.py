@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+'''
+Checks read routing between a primary and a replica. Exits non-zero if a check fails.
+
+    python -m benchmarks.check_replicas
+    python -m benchmarks.check_replicas --primary mysql+pymysql://... --replica mysql+pymysql://...
+
+Without arguments two SQLite files stand in for the pair, the replica being a copy of the primary taken after
+seeding, so it lags every later write. With real servers the replica must already be replicating the primary.
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+STICKY_SECONDS = 1
+
+def _counts(app, client, method, path, **kwargs):
+    ''' (status, statements on the primary, statements on the replica) for one request '''
+    from application import db
+    from .harness import StatementCounter
+    with app.app_context():
+        primary, replica = db.engine, db.get_engine(app, bind = 'replica_0')
+    with StatementCounter(primary) as p, StatementCounter(replica) as r:
+        resp = client.open(path, method = method, **kwargs)
+    return resp, p.count, r.count
+
+def run(app, sqlite_files = None):
+    from application import db
+    from application.replicas import router
+    from application.db_model import Player, Playbook, Character
+    from .harness import seed_catalog
+    with app.app_context():
+        seed_catalog()
+        client = app.test_client()
+        client.post('/register', data = {'name': 'replica_check', 'password': 'pw', 'confirm': 'pw'})
+        player_id = Player.make_id('replica_check')
+        character_id = Character.make_id(player_id, 'Replica Check')
+        if not Character.get(character_id):
+            Character.create_with_defaults(player_id, [('Replica Check', Playbook.get_all()[0].id)])
+        db.session.remove()
+    if sqlite_files:
+        shutil.copyfile(*sqlite_files) # the replica starts as a snapshot of the primary
+    client.post('/login', data = {'name': 'replica_check', 'password': 'pw'})
+    time.sleep(STICKY_SECONDS) # logging in wrote the rehash check, let stickiness lapse
+    path = '/api/character/{}'.format(character_id)
+    checks = []
+
+    resp, p, r = _counts(app, client, 'GET', path)
+    checks.append(('GET reads from the replica', resp.status_code == 200 and r > 0 and p == 0, (resp.status_code, p, r)))
+
+    resp, p, r = _counts(app, client, 'PATCH', path, json = {'fatigue': 3}, headers = {'If-Match': '*'})
+    checks.append(('PATCH writes to the primary', resp.status_code == 200 and p > 0 and r == 0, (resp.status_code, p, r)))
+
+    resp, p, r = _counts(app, client, 'GET', path)
+    fatigue = resp.get_json()['data']['fatigue']
+    checks.append(('GET after a write sticks to the primary', p > 0 and r == 0 and fatigue == 3, (p, r, fatigue)))
+
+    time.sleep(STICKY_SECONDS + 0.1)
+    resp, p, r = _counts(app, client, 'GET', path)
+    checks.append(('GET returns to the replica once stickiness lapses', r > 0 and p == 0, (p, r)))
+
+    if sqlite_files: # take the replica away, the request should still succeed on the primary
+        os.remove(sqlite_files[1])
+        resp, p, r = _counts(app, client, 'GET', path)
+        checks.append(('failing replica falls back to the primary', resp.status_code == 200 and p > 0, (resp.status_code, p, r)))
+    else:
+        router.mark_down('replica_0', 'marked down by check_replicas')
+    resp, p, r = _counts(app, client, 'GET', path)
+    checks.append(('replica marked down is skipped', resp.status_code == 200 and p > 0 and r == 0, (resp.status_code, p, r)))
+    return checks
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--primary')
+    parser.add_argument('--replica')
+    args = parser.parse_args(argv)
+    sqlite_files = None
+    if not args.primary:
+        tmp = tempfile.mkdtemp(prefix = 'avatar_replicas_')
+        sqlite_files = (os.path.join(tmp, 'primary.db'), os.path.join(tmp, 'replica.db'))
+        args.primary, args.replica = ['sqlite:///' + f for f in sqlite_files]
+    os.environ['DATABASE_REPLICA_URIS'] = args.replica
+    os.environ['REPLICA_STICKY_SECONDS'] = str(STICKY_SECONDS)
+    os.environ['REPLICA_RETRY_SECONDS'] = '60'
+    from .harness import boot
+    failures = 0
+    for name, ok, detail in run(boot(args.primary), sqlite_files):
+        failures += not ok
+        print('{:<5} {:<52} {}'.format('ok' if ok else 'FAIL', name, detail))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+''' Compare two benchmark JSON files, exits non-zero if any route's p50 or p99 regressed past the threshold '''
+
+import sys
+import json
+import argparse
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks.compare')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'allowed relative slowdown, default 0.2 = 20%%')
+    args = parser.parse_args(argv)
+    with open(args.baseline) as f:
+        base = json.load(f)
+    with open(args.candidate) as f:
+        cand = json.load(f)
+
+    regressions = []
+    print('{:<28} {:>10} {:>10} {:>8}   {:>10} {:>10} {:>8}'.format('route', 'p50 base', 'p50 new', 'change', 'p99 base', 'p99 new', 'change'))
+    for name in sorted(set(base['routes']) & set(cand['routes'])):
+        row = [name]
+        for key in ('p50_ms', 'p99_ms'):
+            b, c = base['routes'][name][key], cand['routes'][name][key]
+            change = (c - b) / b if b else 0.0
+            row.extend([b, c, '{:+.0%}'.format(change)])
+            if change > args.threshold:
+                regressions.append((name, key, b, c))
+        print('{:<28} {:>10} {:>10} {:>8}   {:>10} {:>10} {:>8}'.format(*row))
+    for name, key, b, c in regressions:
+        print('REGRESSION {} {}: {} -> {} ms'.format(name, key, b, c))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import tempfile
+from contextlib import contextmanager
+
+WEBAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def boot(db_uri = None):
+    ''' Import the app against a local database instead of the mysql container '''
+    tmp = tempfile.mkdtemp(prefix = 'avatar_bench_')
+    os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark')
+    os.environ.setdefault('FLASK_APP_HOST', 'localhost')
+    os.environ.setdefault('FLASK_LOG_DIR', tmp)
+    os.environ.setdefault('DATABASE_URI', db_uri or 'sqlite:///' + os.path.join(tmp, 'avatar.db'))
+    if WEBAPP_DIR not in sys.path:
+        sys.path.insert(0, WEBAPP_DIR)
+    from application import app
+    # in the container templates and static files are copied into the package
+    app.template_folder = os.path.join(WEBAPP_DIR, 'templates')
+    app.static_folder = os.path.join(WEBAPP_DIR, 'static')
+    return app
+
+def seed_catalog(n_playbooks = 12, moves_per_playbook = 4, techniques_per_training = 10):
+    ''' Synthetic rules catalog shaped like the real one. No-op if a catalog is already there '''
+    from application import db
+    from application.db_model import Playbook, Move, Technique, CatalogVersion, trainings, statistics, approaches
+    db.create_all()
+    if Playbook.query.first():
+        return
+    db.session.add(CatalogVersion(id = 1, version = 0))
+    text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 12
+    for i in range(n_playbooks):
+        pid = 'playbook{:024d}'.format(i)
+        db.session.add(Playbook(id = pid, name = 'The Playbook {}'.format(i), creativity = 1, focus = 0, harmony = -1, passion = 1,
+            principle_1 = 'Principle A', principle_2 = 'Principle B', demeanor_options = ['Calm','Bold','Wry','Stern','Warm','Sly'],
+            history_questions = ['Question {}?'.format(q) for q in range(5)], connections = ['Ally of $BLANK$', 'Rival of $BLANK$'],
+            moment_of_balance = text[:500], growth_question = 'Did you grow?'))
+        for j in range(moves_per_playbook):
+            db.session.add(Move(id = 'move{:014d}{:014d}'.format(i, j), name = 'Move {} {}'.format(i, j), move_type = 'Playbook',
+                playbook_id = pid, statistic = statistics[j % 4], description = text[:700],
+                miss_outcome = text[:200], weak_hit_outcome = text[:200], strong_hit_outcome = text[:200]))
+        db.session.add(Technique(id = 'ptech{:027d}'.format(i), name = 'Signature {}'.format(i), technique_type = 'Advanced',
+            approach = approaches[i % 3], req_training = 'Universal', playbook_id = pid, description = text[:600]))
+    for j, move_type in enumerate(['Basic'] * 5 + ['Balance'] * 3 + ['Advancement'] * 2):
+        db.session.add(Move(id = 'smove{:027d}'.format(j), name = '{} Move {}'.format(move_type, j), move_type = move_type,
+            statistic = statistics[j % 4], description = text[:700]))
+    for k, training in enumerate(['Universal'] + trainings):
+        for j in range(techniques_per_training):
+            db.session.add(Technique(id = 'tech{:014d}{:014d}'.format(k, j), name = '{} Technique {}'.format(training, j),
+                technique_type = 'Basic' if j < 2 and training == 'Universal' else 'Advanced', approach = approaches[j % 3],
+                req_training = training, description = text[:800], cost = '1 fatigue', fatigue_cleared = 0,
+                fatigue_inflicted = 1, is_blockable = bool(j % 2), is_rare = j == 0))
+    db.session.commit()
+
+def seed_players(n_players, characters_per_player, password = 'benchmark', prefix = 'player', batch_size = 5000):
+    '''
+    Bulk seed players named <prefix><n> with characters_per_player characters each, spread over the playbooks.
+    Every player gets the same password. Returns the player ids.
+    '''
+    from application import db
+    from application.db_model import Player, Playbook, Character
+    password_hash = Player(prefix, password).password_hash # hash once, every player shares it
+    playbook_ids = [p.id for p in Playbook.get_all()]
+    player_ids, players, characters = [], [], []
+    for i in range(n_players):
+        name = '{}{}'.format(prefix, i)
+        players.append({'id': Player.make_id(name), 'name': name, 'password_hash': password_hash})
+        player_ids.append(players[-1]['id'])
+        for j in range(characters_per_player):
+            characters.append({'player_id': player_ids[-1], 'name': 'Character {}'.format(j),
+                               'playbook_id': playbook_ids[(i + j) % len(playbook_ids)]})
+        if len(players) >= batch_size:
+            db.session.bulk_insert_mappings(Player, players)
+            players.clear()
+            Character.create_with_defaults(None, characters, batch_size = batch_size)
+            characters.clear()
+    db.session.bulk_insert_mappings(Player, players)
+    Character.create_with_defaults(None, characters, batch_size = batch_size)
+    return player_ids
+
+def percentile(sorted_values, p):
+    ''' Nearest-rank percentile of an already sorted list '''
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+def summarize(latencies, elapsed, errors = 0):
+    ''' Throughput and latency summary, latencies in seconds '''
+    latencies = sorted(latencies)
+    ms = lambda v: round(v * 1e3, 3) if v is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1]) if latencies else None
+    }
+
+class StatementCounter(object):
+    ''' Counts SQL statements sent to the engine while active '''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+@contextmanager
+def timer(results, key):
+    start = time.perf_counter()
+    yield
+    results[key] = time.perf_counter() - start
+
+def report(name, rows):
+    print(name)
+    for k, v in rows.items():
+        print('  {:<40} {}'.format(k, v))
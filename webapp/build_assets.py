@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''
+Fingerprint the static css/js for long-lived caching. Run at image build time:
+
+    python build_assets.py [STATIC_DIR]    default application/static
+
+Each asset is copied to STATIC_DIR/build/<path>.<hash>.<ext> alongside .gz and, when the brotli package is
+installed, .br variants where they are smaller. STATIC_DIR/build/manifest.json maps each source path to its
+hashed one. application/assets.py reads the manifest to render URLs and serve the variants. Rerunning replaces the build.
+'''
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+
+try: # optional, smaller than gzip for text assets
+    import brotli
+except ImportError:
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+EXTENSIONS = ('.css', '.js')
+HASH_LENGTH = 12
+
+def fingerprint(path, data):
+    stem, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(stem, hashlib.sha256(data).hexdigest()[:HASH_LENGTH], ext)
+
+def build(static_dir):
+    out_dir = os.path.join(static_dir, BUILD_DIR)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != out_dir]
+        for name in sorted(files):
+            if not name.endswith(EXTENSIONS):
+                continue
+            src = os.path.join(root, name)
+            path = os.path.relpath(src, static_dir).replace(os.sep, '/')
+            with open(src, 'rb') as f:
+                data = f.read()
+            hashed = fingerprint(path, data)
+            dest = os.path.join(out_dir, hashed)
+            os.makedirs(os.path.dirname(dest), exist_ok = True)
+            variants = {'': data, '.gz': gzip.compress(data, 9, mtime = 0)}
+            if brotli is not None:
+                variants['.br'] = brotli.compress(data, quality = 11)
+            variants = {s: b for s, b in variants.items() if not s or len(b) < len(data)} # tiny files do not shrink
+            for suffix, body in variants.items():
+                with open(dest + suffix, 'wb') as f:
+                    f.write(body)
+            manifest[path] = hashed
+            print('{:<32} {:>8} -> {}'.format(path, len(data), '  '.join('{} {}'.format(s or 'raw', len(b)) for s, b in variants.items())))
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
+    return manifest
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else os.path.join('application', 'static'))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+'''
+Load the rules catalog from content files, see application/catalog_loader.py for the format. Run from webapp/
+with the app's environment:
+
+    python catalog_cli.py load DIR [--force]   validate and upsert, a no-op when the content is unchanged
+    python catalog_cli.py check DIR            validate the files on their own, print the content checksum
+
+Exits 1 when validation fails, printing every problem found.
+'''
+
+import sys
+import argparse
+
+from application import app, catalog_loader
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices = ['load', 'check'])
+    parser.add_argument('dir')
+    parser.add_argument('--force', action = 'store_true', help = 'upsert even if the checksum matches')
+    args = parser.parse_intermixed_args(argv)
+    content = catalog_loader.read_dir(args.dir)
+    if not content:
+        print('No playbooks, moves or techniques files in {}'.format(args.dir), file = sys.stderr)
+        return 1
+    with app.app_context():
+        try:
+            if args.command == 'check':
+                print(catalog_loader.checksum(catalog_loader.normalize(content)))
+                return 0
+            result = catalog_loader.load(content, force = args.force)
+        except catalog_loader.CatalogError as e:
+            print(e, file = sys.stderr)
+            return 1
+    if result['changed']:
+        print('Loaded {}: inserted {}, updated {}'.format(result['checksum'][:12], result['inserted'], result['updated']))
+    else:
+        print('Unchanged {}'.format(result['checksum'][:12]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+Back up and move character rosters as NDJSON. Run from webapp/ with the app's environment:
+
+    python roster_cli.py export [--player NAME] [FILE]              stream characters out, stdout by default
+    python roster_cli.py import [--player NAME] [--batch N] [FILE]  bulk load an export, stdin by default
+
+--player limits an export to that player's characters, or makes them the owner of everything imported.
+Import prints per-batch throughput and every rejected line to stderr, and exits 1 if any line was rejected.
+'''
+
+import sys
+import argparse
+
+from application import app, roster
+from application.db_model import Player
+
+def _player_id(name):
+    if not name:
+        return None
+    player = Player.get_name(name)
+    if not player:
+        raise SystemExit('No player named {}'.format(name))
+    return player.id
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices = ['export', 'import'])
+    parser.add_argument('file', nargs = '?', default = '-')
+    parser.add_argument('--player', help = 'player name: export only theirs, or import as theirs')
+    parser.add_argument('--batch', type = int, default = roster.IMPORT_BATCH_SIZE)
+    args = parser.parse_intermixed_args(argv)
+    with app.app_context():
+        player_id = _player_id(args.player)
+        if args.command == 'export':
+            out = sys.stdout.buffer if args.file == '-' else open(args.file, 'wb')
+            with out:
+                for line in roster.export_characters(player_id, args.batch):
+                    out.write(line)
+            return 0
+        report = lambda n, s: print('batch {:>4}  {rows:>6} rows  {inserted:>6} inserted  {skipped:>6} skipped  '
+                                    '{errors:>4} errors  {seconds:>7}s  {rows_per_second} rows/s'.format(n, **s), file = sys.stderr)
+        lines = sys.stdin if args.file == '-' else open(args.file)
+        with lines:
+            totals = roster.import_characters(lines, player_id, args.batch, report)
+        for n, message in totals['errors']:
+            print('line {}: {}'.format(n, message), file = sys.stderr)
+        print('Imported {inserted}, skipped {skipped} existing, {} errors in {seconds:.2f}s'.format(len(totals['errors']), **totals),
+              file = sys.stderr)
+        return 1 if totals['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))